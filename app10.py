@@ -1,23 +1,68 @@
+import codecs
+import contextlib
+import contextvars
+import hashlib
+import httpx
+import itertools
 import json
+import logging
+import math
+import multiprocessing
+import queue
 import re
+import shutil
+import sqlite3
+import threading
 import time
 import uuid
+import tiktoken
+try:
+    import duckdb
+except ImportError:  # 可选依赖：未安装时大文件仍按 DataFrame 加载
+    duckdb = None
+from collections import OrderedDict
+import faiss
 import pickle
+import numpy as np
+import openai
+import openpyxl
+import orjson
 import pandas as pd
 import streamlit as st
+from pydantic import PrivateAttr
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 import plotly.express as px
 import sys
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from langchain.agents import AgentExecutor, Tool, create_react_agent
+from langchain.agents.agent import RunnableAgent
+from langchain.agents.mrkl.prompt import FORMAT_INSTRUCTIONS, PREFIX as REACT_PREFIX, SUFFIX as REACT_SUFFIX
 from langchain.chains.conversation.base import ConversationChain
-from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering import load_qa_chain
 from langchain.memory import ConversationBufferMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.caches import BaseCache
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.load import dumpd, load
+from langchain_core.messages import SystemMessage, get_buffer_string
+from langchain_core.prompts import PromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.tools import BaseTool
 from langchain_openai import ChatOpenAI
 from langchain_community.document_loaders import TextLoader
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_experimental.agents.agent_toolkits import create_pandas_dataframe_agent
 from langchain.embeddings.huggingface import HuggingFaceEmbeddings  # 新增导入
 
+import process_workers
+
 # 设置环境变量
 os.environ["PYTHONIOENCODING"] = "utf-8"
 os.environ["LANG"] = "C.UTF-8"
@@ -25,10 +70,470 @@ os.environ["LC_ALL"] = "C.UTF-8"
 sys.stdout.reconfigure(encoding='utf-8')
 sys.stderr.reconfigure(encoding='utf-8')
 
+logger = logging.getLogger(__name__)
+
+# ============================================================
+# 大模型客户端配置
+# ============================================================
+# 默认接口地址，可用环境变量 OPENAI_BASE_URL 覆盖（例如指向 mock_openai_server.py 做压测）
+LLM_BASE_URL = os.environ.get("OPENAI_BASE_URL", 'https://twapi.openai-hk.com/v1')
+# 所有会话共享同一个连接池，连续提问复用已建立的 TCP/TLS 连接
+LLM_HTTP_CONFIG = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 120,  # 空闲连接保留的秒数
+    "timeout": 120,
+}
+# 客户端注册表最多保留的 ChatOpenAI 实例数（不同模型、采样参数各占一个）
+LLM_REGISTRY_SIZE = 64
+# 各模型每分钟请求数（rpm）与 token 数（tpm）配额，所有会话共享；未列出的模型使用 default
+RATE_LIMIT_CONFIG = {
+    "default": {"rpm": 500, "tpm": 200000},
+    "gpt-4": {"rpm": 200, "tpm": 40000},
+    "gpt-4o": {"rpm": 500, "tpm": 300000},
+    "gpt-4o-mini": {"rpm": 1000, "tpm": 1000000},
+}
+# 429、超时、连接错误和服务端错误的重试策略（指数退避加随机抖动）
+RATE_LIMIT_RETRY_CONFIG = {
+    "max_attempts": 5,
+    "max_wait": 30,
+}
+# 未设置 max_tokens 时按该值预估回答的 token 数
+DEFAULT_COMPLETION_TOKENS = 512
+# "auto" 模型：按问题复杂度在小模型和大模型之间路由
+MODEL_ROUTING_CONFIG = {
+    "small": "gpt-4o-mini",
+    "large": "gpt-4o",
+    "long_query_chars": 40,  # 超过该长度的问题视为较复杂
+    "large_data_rows": 100000,  # 行数或列数超过阈值的数据视为较复杂
+    "large_data_columns": 50,
+    "large_score": 2,  # 复杂度得分达到该值时使用大模型
+}
+# 需要推理、比较或多步分析的问题
+COMPLEX_QUERY_PATTERN = re.compile(
+    r"(为什么|原因|分析|比较|对比|趋势|预测|相关性|归因|解释|建议|策略|评估|推断|总结|异常|假设|如何|怎样)"
+    r"|\b(why|compare|trend|forecast|correlat|explain|recommend|analy[sz]e|summari[sz]e)"
+)
+# 后台执行模型调用、向页面流式输出的线程数
+STREAM_WORKERS = 16
+# 单个请求的截止时间（秒），超时后取消并释放连接
+REQUEST_DEADLINE_SECONDS = 180
+# 数据分析代理的 Python 代码在独立子进程中执行，单段代码超过该时间（秒）后终止子进程
+PYTHON_TOOL_TIMEOUT_SECONDS = 60
+# 模型响应缓存：完全相同的请求（模型、采样参数、完整提示词）直接返回上次的响应
+LLM_RESPONSE_CACHE_CONFIG = {
+    "path": os.path.join(os.path.dirname(os.path.abspath(__file__)), ".index_cache", "llm_responses.sqlite3"),
+    "ttl_seconds": 7 * 24 * 3600,
+    "max_entries": 5000,  # 超出后按最近最少使用淘汰
+    "allow_sampling": False,  # temperature > 0 时默认不使用缓存，设为 True 时同样缓存
+}
+# 对话记忆策略：发送给模型的对话历史按 token 计数，提示词长度不随对话轮数增长
+MEMORY_STRATEGIES = {
+    "window": "滑动窗口（保留最近的对话）",
+    "summary": "滚动摘要（早期对话在后台压缩为摘要）",
+    "buffer": "完整历史（不限长度）",
+}
+MEMORY_CONFIG = {
+    "strategy": "window",  # 默认策略
+    "max_tokens": 1500,  # 对话历史的 token 上限
+    "summary_keep_tokens": 600,  # 生成摘要后保留原文的最近对话 token 数
+    "summary_model": "gpt-4o-mini",  # 生成摘要使用的低成本模型
+    "summary_workers": 4,
+}
+
+# ============================================================
+# 向量索引配置
+# ============================================================
+# 嵌入模型与分块参数，同时参与索引缓存键的计算
+EMBEDDING_CONFIG = {
+    "model_name": "bert-base-chinese",
+}
+TEXT_SPLITTER_CONFIG = {
+    "chunk_size": 1000,
+    "chunk_overlap": 50,
+    "separators": ["\n", "。", "！", "？", "，", "、", ""],
+}
+# 向量索引磁盘缓存目录
+INDEX_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".index_cache")
+# 文本块嵌入向量缓存，文档修改后只需重新计算变化的块
+EMBEDDING_CACHE_PATH = os.path.join(INDEX_CACHE_DIR, "chunk_embeddings.sqlite3")
+# 上传文件落盘目录；文本文件按块读取、按段建立索引、按页预览，内存占用与文件大小无关
+UPLOAD_SPILL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".uploads")
+INGEST_BLOCK_BYTES = 1024 * 1024
+PREVIEW_PAGE_BYTES = 20 * 1024
+# 每个会话保留的已解析数据文件（按内容指纹和工作表区分）数量
+DATA_PARSE_CACHE_SIZE = 4
+# 数据文件加载时转为紧凑的列式表示，并以未压缩的 Arrow IPC 格式缓存在磁盘上，内存映射读取后多个会话共享同一份页面
+COMPACT_DATA_CONFIG = {
+    # 文本列改用 Arrow 字符串；数值列保持 int64 / float64、不转分类类型，代理执行的代码不会因类型变窄而溢出或出现空分组
+    "arrow_strings": True,
+    "format_version": 2,  # 转换规则或文件格式变化时递增，旧的缓存文件不再使用
+    "cache_dir": os.path.join(UPLOAD_SPILL_DIR, "arrow"),
+}
+# Excel 工作簿：只解析选中的工作表，其余工作表在后台进程中预解析并写入 Arrow 缓存，切换时直接读取
+EXCEL_LOAD_CONFIG = {
+    "prefetch": True,
+    "workers": min(2, os.cpu_count() or 1),
+    "max_prefetch_sheets": 50,  # 每个工作簿最多预解析的工作表数
+    "wait_seconds": 30,  # 选中的工作表正在后台解析时最多等待的秒数，超时后在前台解析
+}
+# 数据集概况：每个数据集只计算一次，替代提示词中的数据预览，长度不超过 token 预算
+DATA_PROFILE_CONFIG = {
+    "token_budget": 800,
+    "sample_rows": 3,  # 预算允许时附带的示例行数
+    "top_values": 5,  # 文本列列出的常见取值个数
+    "max_value_chars": 20,  # 单个取值最多显示的字符数
+}
+# 超过该大小的 CSV 导入磁盘上的嵌入式 DuckDB 数据库（需要安装 duckdb），代理编写 SQL 查询，只有查询结果进入内存
+SQL_ENGINE_CONFIG = {
+    "threshold_bytes": 100 * 1024 ** 2,
+    "db_dir": os.path.join(UPLOAD_SPILL_DIR, "duckdb"),
+    "memory_limit": "1GB",  # 超出后 DuckDB 把中间结果溢出到磁盘
+    "threads": 4,
+    "max_result_rows": 200,  # 每次查询返回给代理的最多行数
+    "max_iterations": 5,  # SQL 出错后需要额外的步骤修正
+}
+# 流式嵌入流水线：按模型最优批大小切分，由多进程并行编码
+EMBED_PIPELINE_CONFIG = {
+    "batch_size": 32,
+    "workers": min(4, os.cpu_count() or 1),
+}
+# 上传文档后立即在后台建立索引；索引未完成时是否基于已处理的文本块先行回答
+INDEXING_WORKERS = 2
+RAG_PARTIAL_ANSWERS = True
+# 多文档问答时并行检索各文档索引分片的线程数
+SEARCH_WORKERS = 8
+# 向量索引类型：auto 按文档规模选择，小文档用精确的 flat 索引，大文档用 HNSW 或 IVF 近似索引
+VECTOR_INDEX_CONFIG = {
+    "mode": "auto",  # auto / flat / hnsw / ivf
+    "flat_max_chunks": 10000,  # auto 模式下不超过该块数时使用 flat
+    "large_mode": "hnsw",  # auto 模式下大文档使用的索引类型
+    "hnsw_m": 32,
+    "hnsw_ef_construction": 80,
+    "ivf_nlist": 0,  # 0 表示按 4·√N 自动确定
+    "quantization": None,  # None / sq8（int8 标量量化，约 1/4 内存）/ pq（乘积量化）
+    "pq_m": 64,  # 乘积量化的子向量个数，每个向量压缩为 pq_m 字节
+    "pq_nbits": 8,
+}
+# 近似索引的查询参数，只影响检索，修改后无需重建索引
+VECTOR_SEARCH_CONFIG = {
+    "hnsw_ef_search": 64,
+    "ivf_nprobe": 16,
+    "rerank_factor": 4,  # 压缩索引先取 k×该倍数个候选，再用嵌入缓存中的原始向量精确重排；0 表示不重排
+}
+
+# 检索上下文打包：多取候选文本块，去掉块间重叠后按 token 预算装入提示词
+CONTEXT_PACKING_CONFIG = {
+    "fetch_k": 8,  # 每次检索的候选文本块数量
+    "baseline_k": 4,  # 打包前直接使用的检索结果数量，作为统计上下文 token 变化的基准
+    "token_budget": 2000,  # 检索上下文最多占用的 token 数
+    "min_overlap_chars": 10,  # 重叠短于该长度时不做裁剪，避免误删
+}
+
+# 追问改写：快速模式下独立问题不再调用大模型改写，追问改写时并行检索原始问题
+RAG_CONDENSE_CONFIG = {
+    "condense_model": "gpt-4o-mini",  # 改写追问所用的低成本模型，为 None 时使用对话模型
+    "speculative_retrieval": True,  # 改写的同时先用原始问题检索，改写结果不变时直接复用
+}
+# 出现这些指代或承接词时认为问题依赖上文，需要改写
+FOLLOW_UP_PATTERN = re.compile(
+    r"(它|他们|她们|这个|那个|这些|那些|这里|那里|上面|上述|前面|刚才|之前|其中|此外|还有|然后|继续|同样|呢[？?]?$)"
+    r"|\b(it|its|they|them|this|that|these|those|above|previous|he|she)\b"
+)
+
+# 语义回答缓存：措辞不同的同一问题直接复用已有回答，不再请求大模型
+# 相似度阈值是经验取值，没有针对所用嵌入模型（bert-base-chinese / MiniLM）在中文问题对上校准过：
+# 只差一个数字、日期或实体的问题（如“3月销售额”和“4月销售额”）向量相似度可能高于阈值，
+# 所以命中还要求两个问题的关键词完全一致（见 question_terms）。调整阈值前应先用标注过的同义/不同义问题对检验。
+ANSWER_CACHE_CONFIG = {
+    "similarity_threshold": 0.97,  # 问题向量的余弦相似度不低于该值，且关键词一致时视为同一问题
+    "ttl_seconds": 24 * 3600,  # 回答的有效期
+    "max_entries": 2000,  # 超出后按最近最少使用淘汰
+    "query_embedding_cache_size": 4096,  # 问题向量缓存的条数
+}
+# 比较问题关键词时忽略的虚词和疑问词用字，其余汉字、数字和英文词都必须一致
+QUESTION_FILLER_CHARS = set("的了吗呢吧啊呀么是请问下个这那些我你您们怎样如何什么哪能可以会要想帮给说讲告诉介绍和与及或还也都就")
+QUESTION_TERM_PATTERN = re.compile(r"\d+(?:\.\d+)?|[a-z][a-z0-9_\-]*|[\u4e00-\u9fff]")
+
 
 # ============================================================
 # 文件上传处理功能
 # ============================================================
+def ingest_text_upload(uploaded_file):
+    """流式读取上传的文本文件：逐块校验 UTF-8、计算指纹并写入磁盘，同时记录预览分页位置
+
+    返回的文档描述只包含路径和元数据，全文不会以字符串形式驻留在会话状态中。
+    """
+    os.makedirs(UPLOAD_SPILL_DIR, exist_ok=True)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    digest = hashlib.sha256()
+    page_offsets = [0]
+    next_page = PREVIEW_PAGE_BYTES
+    size = 0
+
+    tmp_path = os.path.join(UPLOAD_SPILL_DIR, f"{uuid.uuid4().hex}.tmp")
+    uploaded_file.seek(0)
+    try:
+        with open(tmp_path, "wb") as f:
+            while block := uploaded_file.read(INGEST_BLOCK_BYTES):
+                decoder.decode(block)  # 非法 UTF-8 会在这里抛出 UnicodeDecodeError
+                digest.update(block)
+                f.write(block)
+
+                # 每满一页在其后最近的换行处分页，找不到换行时直接按字节切分
+                while next_page < size + len(block):
+                    pos = next_page - size
+                    newline = block.find(b"\n", pos, pos + 4096)
+                    cut = size + (newline + 1 if newline != -1 else pos)
+                    page_offsets.append(cut)
+                    next_page = cut + PREVIEW_PAGE_BYTES
+                size += len(block)
+            decoder.decode(b"", final=True)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    # 以内容指纹命名，相同文档只保留一份
+    fingerprint = digest.hexdigest()
+    path = os.path.join(UPLOAD_SPILL_DIR, f"{fingerprint}.txt")
+    os.replace(tmp_path, path)
+    if page_offsets[-1] != size or len(page_offsets) == 1:
+        page_offsets.append(size)
+
+    return {
+        "name": uploaded_file.name,
+        "path": path,
+        "fingerprint": fingerprint,
+        "size": size,
+        "page_offsets": page_offsets,
+    }
+
+
+def read_text_page(doc, page):
+    """按页读取文档内容用于预览，页码从 0 开始"""
+    start, end = doc["page_offsets"][page], doc["page_offsets"][page + 1]
+    with open(doc["path"], "rb") as f:
+        f.seek(start)
+        # 按字节切分的页边界可能截断多字节字符
+        return f.read(end - start).decode("utf-8", errors="ignore")
+
+
+def iter_text_segments(path):
+    """按段读取磁盘上的文档，段尾对齐到换行处；产出 (文本段, 累计已读取字节数)"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    carry = ""
+    bytes_read = 0
+    with open(path, "rb") as f:
+        while block := f.read(INGEST_BLOCK_BYTES):
+            bytes_read += len(block)
+            text = carry + decoder.decode(block)
+            cut = text.rfind("\n") + 1 or len(text)
+            carry = text[cut:]
+            if cut:
+                yield text[:cut], bytes_read
+    tail = carry + decoder.decode(b"", final=True)
+    if tail:
+        yield tail, bytes_read
+
+
+def upload_fingerprint(uploaded_file):
+    """上传文件内容的 SHA-256 指纹；同一次上传（file_id 相同）只计算一次"""
+    fingerprints = st.session_state.upload_fingerprints
+    if uploaded_file.file_id not in fingerprints:
+        with uploaded_file.getbuffer() as buffer:
+            fingerprints[uploaded_file.file_id] = hashlib.sha256(buffer).hexdigest()
+    return fingerprints[uploaded_file.file_id]
+
+
+def copy_upload(uploaded_file, path):
+    """按 INGEST_BLOCK_BYTES 分块把上传文件写入 path，不在内存中生成整个文件的副本"""
+    uploaded_file.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, INGEST_BLOCK_BYTES)
+
+
+def cached_parse(fingerprint, sheet, parse):
+    """按 (内容指纹, 工作表) 缓存解析结果，页面重跑时直接返回同一个对象而不再解析或复制
+
+    返回缓存条目 {"data": 解析结果, "seconds": 解析耗时, "reuses": 复用次数}。
+    """
+    cache = st.session_state.parsed_data
+    key = (fingerprint, sheet)
+    entry = cache.get(key)
+    if entry is not None:
+        cache.move_to_end(key)
+        entry["reuses"] += 1
+        return entry
+
+    start = time.perf_counter()
+    entry = {"data": parse(), "seconds": time.perf_counter() - start, "reuses": 0}
+    logger.info("解析上传数据 %s（%s）耗时 %.2fs", fingerprint[:12], sheet, entry["seconds"])
+    cache[key] = entry
+    while len(cache) > DATA_PARSE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return entry
+
+
+def compact_cache_path(fingerprint, sheet):
+    """数据文件（或工作表）紧凑表示的 Arrow 缓存路径，转换设置也计入文件名，修改设置后不会读到旧的缓存"""
+    settings = {key: value for key, value in COMPACT_DATA_CONFIG.items() if key != "cache_dir"}
+    name = hashlib.sha256(json.dumps([fingerprint, sheet, settings], sort_keys=True).encode()).hexdigest()
+    return os.path.join(COMPACT_DATA_CONFIG["cache_dir"], f"{name}.arrow")
+
+
+def load_compact_dataset(fingerprint, sheet, read):
+    """读取上传的数据并转为紧凑表示，结果以 Arrow IPC 格式缓存在磁盘上
+
+    再次加载相同内容时内存映射读取缓存文件，不再解析原始文件；首次解析写入缓存后也改用映射的版本，
+    释放堆中的副本。工作表正在后台预解析时等待其完成。
+    返回 {"df", "original_bytes", "compact_bytes", "source", "path"}，path 为缓存文件路径，没有写入缓存时为 None。
+    """
+    path = compact_cache_path(fingerprint, sheet)
+    wait_for_sheet_prefetch(fingerprint, sheet)
+    if os.path.exists(path):
+        try:
+            df, original_bytes = process_workers.read_compact_arrow(path)
+            return {
+                "df": df,
+                "original_bytes": original_bytes,
+                "compact_bytes": int(df.memory_usage(deep=True).sum()),
+                "source": "arrow",
+                "path": path,
+            }
+        except Exception as e:
+            logger.warning("Arrow 缓存读取失败，重新解析: %s", e)
+
+    config = COMPACT_DATA_CONFIG
+    df = read()
+    original_bytes = int(df.memory_usage(deep=True).sum())
+    df = process_workers.compact_dataframe(df, config["arrow_strings"])
+    try:
+        process_workers.write_compact_arrow(df, original_bytes, path)
+        df, _ = process_workers.read_compact_arrow(path)
+    except Exception as e:
+        # 混合类型等无法转换为 Arrow 的数据只是不写缓存，继续使用堆中的数据
+        logger.warning("Arrow 缓存写入失败: %s", e)
+        path = None
+    return {
+        "df": df,
+        "original_bytes": original_bytes,
+        "compact_bytes": int(df.memory_usage(deep=True).sum()),
+        "source": "parse",
+        "path": path,
+    }
+
+
+def save_excel_upload(fingerprint, uploaded_file):
+    """把上传的工作簿写入磁盘供只读读取和后台进程使用，相同内容只写一次"""
+    path = os.path.join(UPLOAD_SPILL_DIR, f"{fingerprint}.xlsx")
+    if not os.path.exists(path):
+        os.makedirs(UPLOAD_SPILL_DIR, exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        copy_upload(uploaded_file, tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+def list_sheet_names(path):
+    """以只读模式打开工作簿，只读取工作表目录而不解析任何工作表"""
+    workbook = openpyxl.load_workbook(path, read_only=True, keep_links=False)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+@st.cache_resource
+def get_excel_pool():
+    """进程级共享的工作表解析进程池"""
+    return ProcessPoolExecutor(
+        max_workers=EXCEL_LOAD_CONFIG["workers"],
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@st.cache_resource
+def get_sheet_prefetch_jobs():
+    """进程内正在后台解析的工作表：(内容指纹, 工作表) → Future，多个会话共用"""
+    return {}, threading.Lock()
+
+
+def prefetch_excel_sheets(fingerprint, path, sheet_names):
+    """把尚未缓存的工作表提交到进程池，在后台解析并写入 Arrow 缓存"""
+    jobs, lock = get_sheet_prefetch_jobs()
+    config = COMPACT_DATA_CONFIG
+    submitted = []
+    with lock:
+        for sheet in sheet_names[:EXCEL_LOAD_CONFIG["max_prefetch_sheets"]]:
+            key = (fingerprint, sheet)
+            cache_path = compact_cache_path(fingerprint, sheet)
+            if key in jobs or os.path.exists(cache_path):
+                continue
+            try:
+                future = get_excel_pool().submit(
+                    process_workers.parse_excel_sheet, path, sheet, cache_path, config["arrow_strings"]
+                )
+            except BrokenProcessPool as e:
+                # 子进程异常退出后进程池不再可用，下次重新创建；本次不再预解析
+                logger.warning("工作表解析进程池不可用: %s", e)
+                get_excel_pool.clear()
+                break
+            jobs[key] = future
+            submitted.append((key, future))
+
+    def unregister(future, key):
+        with lock:
+            jobs.pop(key, None)
+        if not future.cancelled() and future.exception() is not None:
+            # 无法写入缓存的工作表在用户选中时照常在前台解析
+            logger.warning("工作表 %s 后台解析失败: %s", key[1], future.exception())
+
+    # 已经完成的任务会在 add_done_callback 中立即执行回调，所以要在释放锁之后注册
+    for key, future in submitted:
+        future.add_done_callback(lambda future, key=key: unregister(future, key))
+
+
+def wait_for_sheet_prefetch(fingerprint, sheet):
+    """选中的工作表已提交后台解析时：还在排队就取消，由前台直接解析；正在解析则限时等待其完成
+
+    等待超时或后台解析失败时返回，调用方照常在前台解析。
+    """
+    jobs, lock = get_sheet_prefetch_jobs()
+    with lock:
+        future = jobs.get((fingerprint, sheet))
+    if future is None or future.cancel():
+        return
+    try:
+        future.result(timeout=EXCEL_LOAD_CONFIG["wait_seconds"])
+    except TimeoutError:
+        logger.warning("工作表 %s 后台解析超过 %s 秒，改为前台解析", sheet, EXCEL_LOAD_CONFIG["wait_seconds"])
+    except Exception:
+        pass  # 失败原因已在 unregister 中记录
+
+
+def load_data_upload(fingerprint, sheet, read):
+    """把数据文件（或 Excel 的一个工作表）加载到 st.session_state.data_df，重跑时直接复用"""
+    entry = cached_parse(fingerprint, sheet, lambda: load_compact_dataset(fingerprint, sheet, read))
+    st.session_state.data_parse = entry
+    st.session_state.data_df = entry["data"]["df"]
+
+
+def load_sql_upload(fingerprint, uploaded_file):
+    """大文件导入 DuckDB，st.session_state.data_df 中保存的是 SqlDataset 而不是 DataFrame"""
+    def ingest():
+        with st.spinner("文件较大，正在导入 DuckDB..."):
+            dataset = SqlDataset(ingest_sql_dataset(fingerprint, uploaded_file))
+        return {"df": dataset, "original_bytes": uploaded_file.size, "compact_bytes": 0, "source": "duckdb"}
+
+    entry = cached_parse(fingerprint, None, ingest)
+    st.session_state.data_parse = entry
+    st.session_state.data_df = entry["data"]["df"]
+
+
+def format_bytes(size):
+    return f"{size / 1024 ** 2:.1f} MB" if size >= 1024 ** 2 else f"{size / 1024:.1f} KB"
+
+
 def process_uploaded_file(uploaded_file):
     """处理上传的文件"""
     try:
@@ -36,13 +541,19 @@ def process_uploaded_file(uploaded_file):
         session_id = str(uuid.uuid4())
 
         if file_ext in ["csv", "xlsx"]:
+            # 页面每次重跑都会进入这里，相同内容只解析一次
+            fingerprint = upload_fingerprint(uploaded_file)
+            uploaded_file.seek(0)
             if file_ext == "csv":
-                st.session_state.data_df = pd.read_csv(uploaded_file)
+                if duckdb is not None and uploaded_file.size >= SQL_ENGINE_CONFIG["threshold_bytes"]:
+                    load_sql_upload(fingerprint, uploaded_file)
+                else:
+                    load_data_upload(fingerprint, None, lambda: pd.read_csv(uploaded_file))
                 st.session_state.current_mode = "📊 数据分析"
                 st.success("CSV文件已成功加载！")
             else:  # xlsx
-                excel_file = pd.ExcelFile(uploaded_file)
-                sheet_names = excel_file.sheet_names
+                path = save_excel_upload(fingerprint, uploaded_file)
+                sheet_names = cached_parse(fingerprint, "", lambda: list_sheet_names(path))["data"]
 
                 if 'selected_sheet' not in st.session_state:
                     st.session_state.selected_sheet = sheet_names[0] if sheet_names else None
@@ -63,22 +574,33 @@ def process_uploaded_file(uploaded_file):
                         )
 
                         st.session_state.selected_sheet = selected_sheet
-                        st.session_state.data_df = excel_file.parse(selected_sheet)
+                        load_data_upload(
+                            fingerprint, selected_sheet,
+                            lambda: pd.read_excel(path, sheet_name=selected_sheet, engine="openpyxl")
+                        )
                         st.session_state.current_mode = "📊 数据分析"
                         st.success(f"Excel文件的工作表 '{selected_sheet}' 已成功加载！")
+
+                        # 选中的工作表加载完成后再在后台预解析其余工作表
+                        if EXCEL_LOAD_CONFIG["prefetch"] and len(sheet_names) > 1:
+                            prefetch_excel_sheets(fingerprint, path, sheet_names)
+                            ready = sum(os.path.exists(compact_cache_path(fingerprint, name)) for name in sheet_names)
+                            if ready < len(sheet_names):
+                                st.caption(f"已解析 {ready}/{len(sheet_names)} 个工作表，其余正在后台解析")
                     else:
                         st.error("Excel文件中没有找到任何工作表！")
 
         elif file_ext == "txt":
-            content = uploaded_file.read().decode("utf-8")
-            file_path = f"{session_id}.txt"
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content)
-            st.session_state.txt_content = content
-            st.session_state.session_id = session_id
-            st.session_state.is_new_file = True
+            # 页面每次重跑都会进入这里，同一次上传只读取一次
+            if uploaded_file.file_id not in st.session_state.txt_docs:
+                doc = ingest_text_upload(uploaded_file)
+                st.session_state.txt_docs[uploaded_file.file_id] = doc
+                st.session_state.session_id = session_id
+                # 每个文档独立建立索引分片并在后台进行，新增文档不会重建其他文档的索引
+                if doc["fingerprint"] not in st.session_state.index_jobs:
+                    st.session_state.index_jobs[doc["fingerprint"]] = submit_indexing_job(doc["path"], doc["fingerprint"])
             st.session_state.current_mode = "📚 文档问答"
-            st.success("文本文件已成功上传！")
+            st.success(f"文本文件 '{uploaded_file.name}' 已成功上传！")
 
         else:
             st.error("不支持的文件类型！")
@@ -95,8 +617,8 @@ DF_AGENT_PROMPT_TEMPLATE = """
 你是一个数据分析专家，请根据以下数据框和用户问题提供回答。
 必须严格按照指定格式回复，否则系统将无法解析！
 
-**数据框预览**:
-{df_head}
+**数据概况**:
+{df_profile}
 
 **用户问题**: {query}
 
@@ -151,6 +673,49 @@ DF_AGENT_PROMPT_TEMPLATE = """
 16. 确保JSON格式正确：键名使用双引号，字符串值使用双引号，数值不使用引号
 """
 
+# SQL 代理提示词模板 - 数据保存在 DuckDB 中的大数据集
+SQL_AGENT_PROMPT_TEMPLATE = """
+你是一个数据分析专家，数据集保存在 DuckDB 数据库的 data 表中，请根据以下数据概况和用户问题提供回答。
+必须严格按照指定格式回复，否则系统将无法解析！
+
+**数据概况**:
+{df_profile}
+
+**用户问题**: {query}
+
+**响应格式要求**:
+- 纯文本回答 (如果没有可视化需求)
+- 或JSON格式 (如果需要展示图表):
+{{
+    "answer": "详细文本解释(解释用户问题)和统计结果:",
+    "charts": [
+        {{
+            "type": "bar/line/pie/scatter/box/hist/area",
+            "data": {{
+                "columns": ["类别A", "类别B", ...],
+                "data": [数值1, 数值2, ...]
+            }},
+            "title": "图表标题 (可选)"
+        }}
+    ]
+}}
+
+**重要规则**:
+1. 数据量很大，只能通过 sql_db_query 工具执行 DuckDB SQL 查询，不要尝试读取全部数据
+2. 在 SQL 中完成过滤、分组和聚合，只查询回答问题需要的少量结果行，明细查询必须加 LIMIT
+3. 按月统计时使用 strftime(日期列, '%Y-%m') 得到 "YYYY-MM" 格式的月份，并按月份排序
+4. 列名包含中文或特殊字符时用双引号括起来
+5. 如果遇到错误，返回 JSON 格式的错误信息: {{"error": "错误描述", "answer": "错误信息"}}
+6. 不要包含任何额外解释或 SQL 代码
+7. 用户没有明确要求图表时，请仅返回文本答案
+8. 不要返回数据预览内容，用户已经在上传文件时看到数据预览
+9. 图表数据中每个数组元素都包含 2 个值，例如 ["2020-01", 5409855]，每个类别或月份只出现一次
+10. 确保JSON格式正确：键名使用双引号，字符串值使用双引号，数值不使用引号
+"""
+
+# 图表关键词列表
+CHART_KEYWORDS = ["图表", "柱状图", "折线图", "饼图", "可视化", "展示图", "散点图", "箱线图", "直方图", "面积图"]
+
 # 文本代理提示词模板
 TEXT_AGENT_PROMPT_TEMPLATE = "你是一个乐于助人的AI助手，用中文回答问题"
 
@@ -168,28 +733,42 @@ def init_session_state():
             {'role': 'ai', 'content': '你好，我是你的AI助手，请问有什么能帮助你吗？'}]
     if 'history_sessions' not in st.session_state:
         st.session_state.history_sessions = []  # 存储所有历史会话
+    if 'memory_strategy' not in st.session_state:
+        st.session_state.memory_strategy = MEMORY_CONFIG["strategy"]
     if 'memory' not in st.session_state:
-        st.session_state.memory = ConversationBufferMemory(return_messages=True)
+        st.session_state.memory = create_memory(st.session_state.memory_strategy)
     if 'data_df' not in st.session_state:
         st.session_state.data_df = None
-    if 'txt_content' not in st.session_state:
-        st.session_state.txt_content = None
+    if 'parsed_data' not in st.session_state:
+        st.session_state.parsed_data = OrderedDict()  # (内容指纹, 工作表) → 解析结果
+    if 'upload_fingerprints' not in st.session_state:
+        st.session_state.upload_fingerprints = {}  # 上传文件编号 → 内容指纹
+    if 'txt_docs' not in st.session_state:
+        st.session_state.txt_docs = {}  # 文档库：上传文件编号 → 文档描述
     if 'viewing_history' not in st.session_state:
         st.session_state.viewing_history = False
     if 'current_session_index' not in st.session_state:
         st.session_state.current_session_index = None
     if 'session_id' not in st.session_state:
         st.session_state.session_id = uuid.uuid4().hex
-    if 'is_new_file' not in st.session_state:
-        st.session_state.is_new_file = True
+    if 'index_jobs' not in st.session_state:
+        st.session_state.index_jobs = {}  # 文档指纹 → 后台索引任务
     if 'API_KEY' not in st.session_state:
         st.session_state.API_KEY = ""
+    if 'base_url' not in st.session_state:
+        st.session_state.base_url = LLM_BASE_URL
     if 'selected_model' not in st.session_state:
         st.session_state.selected_model = "gpt-4o-mini"
+    if 'active_model' not in st.session_state:
+        st.session_state.active_model = "gpt-4o-mini"  # 本次请求实际使用的模型
     if 'model_temperature' not in st.session_state:
         st.session_state.model_temperature = 0.7
     if 'model_max_length' not in st.session_state:
         st.session_state.model_max_length = 1000
+    if 'active_request' not in st.session_state:
+        st.session_state.active_request = None  # 本会话正在后台执行的请求
+    if 'rag_fast_mode' not in st.session_state:
+        st.session_state.rag_fast_mode = True
     if 'system_prompt' not in st.session_state:
         st.session_state.system_prompt = RAG_AGENT_PROMPT_TEMPLATE
     if 'current_mode' not in st.session_state:
@@ -294,21 +873,59 @@ def create_chart(input_data, chart_type):
         st.error(f"数据格式: {input_data}")
 
 
+def text_cache_scope(chain):
+    """文本问答的缓存作用域：模型、生成参数、提示词和当前对话历史都相同时才复用回答
+
+    回答依赖之前的对话（如“总结刚才的回答”），只按问题匹配会用到其他会话的回答。
+    """
+    history = chain.memory.load_memory_variables({})[chain.memory.memory_key]
+    text = get_buffer_string(history) if isinstance(history, list) else history
+    fingerprint = hashlib.sha256(f"{chain.prompt.template}\0{text}".encode("utf-8")).hexdigest()
+    return ("text", *generation_scope(), fingerprint)
+
+
 # 文本代理 - 处理无文件情况
 def text_agent(query):
     try:
-        model = ChatOpenAI(
-            api_key=st.session_state.API_KEY,
-            base_url='https://twapi.openai-hk.com/v1',
-            model=st.session_state.selected_model,
-            temperature=st.session_state.model_temperature,
-            max_tokens=st.session_state.model_max_length
-        )
-        chain = ConversationChain(llm=model, memory=st.session_state.memory)
-        return chain.invoke({'input': query})['response']
+        # 对话链绑定本会话的记忆，模型和记忆都未变化时复用
+        start = time.perf_counter()
+        model = get_chat_model(streaming=True)
+        memory = get_conversation_memory()
+        cached_chain = st.session_state.get("text_chain")
+        if cached_chain is not None and cached_chain.llm is model and cached_chain.memory is memory:
+            chain = cached_chain
+        else:
+            chain = ConversationChain(llm=model, memory=memory)
+            st.session_state.text_chain = chain
+
+        # 相似问题直接返回缓存的回答，并照常写入对话记忆；嵌入模型不可用时跳过缓存直接调用模型
+        answer_cache = get_answer_cache()
+        cache_scope = text_cache_scope(chain)
+        try:
+            cached = answer_cache.lookup(cache_scope, query)
+        except Exception as e:
+            logger.warning("语义缓存查询失败，直接调用模型：%s", e)
+            cached = None
+        if cached is not None:
+            memory.save_context({"input": query}, {"output": cached})
+            st.write(cached)
+            return {"answer": cached, "streamed": True}
+
+        # 回答逐 token 写入页面，对话记忆由链在后台线程中照常更新
+        run = start_request(lambda callbacks: chain.invoke({'input': query}, config={"callbacks": callbacks})['response'])
+        streamed = st.write_stream(run.tokens())
+        answer = run.wait()
+        if not streamed:
+            st.write(answer)
+        timings = {"首字": run.time_to_first_output() or 0.0, "总耗时": time.perf_counter() - start}
+        try:
+            answer_cache.store(cache_scope, query, answer)
+        except Exception as e:
+            logger.warning("语义缓存写入失败：%s", e)
+        return {"answer": answer, "streamed": True, "timings": timings}
     except Exception as e:
         st.error(f"文本处理出错：{e}")
-        return "无法处理您的请求，请检查配置或重试。"
+        return {"answer": "无法处理您的请求，请检查配置或重试。"}
 
 
 # 提取图表数据
@@ -363,35 +980,87 @@ def safe_json_parse(response_text):
     return None
 
 
-# 数据框代理 - 处理CSV/Excel文件
-def dataframe_agent(df, query):
-    try:
-        # 使用提示词模板
-        structured_prompt = DF_AGENT_PROMPT_TEMPLATE.format(
-            df_head=df.head(3).to_string(),
-            query=query
-        )
+def is_unparseable_output(query, response):
+    """代理因解析失败或步数用尽而中止，或者要求了图表却没有返回可解析的图表 JSON"""
+    if not isinstance(response, str) or response.startswith("Agent stopped"):
+        return True
+    if any(kw in query.lower() for kw in CHART_KEYWORDS):
+        parsed = safe_json_parse(response)
+        return not (isinstance(parsed, dict) and parsed.get("charts"))
+    return False
 
-        # 创建代理 - 显式设置响应编码
+
+def run_dataframe_agent(df, structured_prompt):
+    """用当前模型运行数据分析代理，返回代理的原始输出"""
+    # 创建代理 - 显式设置响应编码；同一数据集按模型缓存，自动路由在模型之间切换时也不重建
+    model = get_chat_model(
+        temperature=0.2,
+        request_timeout=REQUEST_DEADLINE_SECONDS,
+        model_kwargs={'response_format': {'type': 'text'}}  # 确保响应是文本格式
+    )
+    agents = st.session_state.get("df_agent")
+    if agents is None or agents[0] is not df:
+        release_df_agent()
+        sandbox = None if isinstance(df, SqlDataset) else \
+            PythonSandbox(df, dataset_cache_path(df), PYTHON_TOOL_TIMEOUT_SECONDS)
+        agents = (df, {}, sandbox)  # (数据集, {id(模型): (模型, 代理)}, 执行代码的子进程)
+        st.session_state.df_agent = agents
+    cached_agent = agents[1].get(id(model))
+    if cached_agent is not None and cached_agent[0] is model:
+        agent = cached_agent[1]
+    elif isinstance(df, SqlDataset):
+        agent = create_sql_dataset_agent(model, df)
+        agents[1][id(model)] = (model, agent)
+    else:
         agent = create_pandas_dataframe_agent(
-            ChatOpenAI(
-                api_key=st.session_state.API_KEY,
-                base_url='https://twapi.openai-hk.com/v1',
-                model=st.session_state.selected_model,
-                temperature=0.2,
-                max_tokens=st.session_state.model_max_length,
-                model_kwargs={'response_format': {'type': 'text'}}  # 确保响应是文本格式
-            ),
+            model,
             df,
             verbose=True,
             handle_parsing_errors=lambda _: "请按指定格式回复",
             max_iterations=3,
+            max_execution_time=REQUEST_DEADLINE_SECONDS,  # 超时后不再开始新的推理步骤
             allow_dangerous_code=True,
-            include_df_in_prompt=True
+            include_df_in_prompt=False  # 数据概况已在问题中给出
         )
+        # 代理生成的代码改在可终止的子进程中执行，取消或超时后不再占用模型调用线程和 CPU
+        python_tool = agent.tools[0]
+        sandbox_tool = SandboxedPythonTool(name=python_tool.name, description=python_tool.description)
+        sandbox_tool.bind(agents[2])
+        agent.tools = [sandbox_tool]
+        agents[2].start()
+        agents[1][id(model)] = (model, agent)
+
+    # 获取代理响应：代理在后台线程运行，思考和工具调用步骤实时显示
+    run = start_request(lambda callbacks: agent.invoke(structured_prompt, config={"callbacks": callbacks})['output'])
+    with st.status("🔍 正在分析数据...", expanded=True) as status:
+        for kind, payload in run.events():
+            if kind == "step":
+                st.text(payload.strip())
+            elif kind == "observation":
+                st.caption(f"Observation: {payload[:500]}")
+        response = run.wait()
+        timings = {"首个步骤": run.time_to_first_output() or 0.0, "总耗时": time.perf_counter() - run.started}
+        status.update(label=f"✅ 分析完成（{format_timings(timings)}）", state="complete", expanded=False)
+    return response
 
-        # 获取代理响应并显式解码为UTF-8
-        response = agent.invoke(structured_prompt)['output']
+
+# 数据框代理 - 处理CSV/Excel文件
+def dataframe_agent(df, query):
+    try:
+        # 使用提示词模板（大数据集保存在 DuckDB 中时由代理编写 SQL）
+        template = SQL_AGENT_PROMPT_TEMPLATE if isinstance(df, SqlDataset) else DF_AGENT_PROMPT_TEMPLATE
+        structured_prompt = template.format(
+            df_profile=get_data_profile(df),
+            query=query
+        )
+
+        response = run_dataframe_agent(df, structured_prompt)
+        # 自动路由选中的小模型没有给出可解析的输出时，改用大模型重试一次
+        if can_escalate() and is_unparseable_output(query, response):
+            get_route_stats().record_escalation()
+            st.session_state.active_model = MODEL_ROUTING_CONFIG["large"]
+            st.caption(f"↗️ 输出无法解析，改用 {st.session_state.active_model} 重新分析")
+            response = run_dataframe_agent(df, structured_prompt)
 
         # 显式编码为UTF-8
         if isinstance(response, str):
@@ -435,52 +1104,1901 @@ def dataframe_agent(df, query):
         }
 
 
-# RAG代理 - 处理TXT文件
-def rag_agent(query):
+# ============================================================
+# 大数据集 SQL 模式
+# ============================================================
+@st.cache_resource
+def get_duckdb_connection(path):
+    """进程级共享的只读 DuckDB 连接，各线程通过 cursor() 并发查询"""
+    connection = duckdb.connect(path, read_only=True, config=duckdb_config())
+    connection.execute("SET enable_external_access = false")  # 代理生成的 SQL 不能读写其他文件
+    return connection
+
+
+def duckdb_config():
+    config = SQL_ENGINE_CONFIG
+    return {
+        "memory_limit": config["memory_limit"],
+        "threads": config["threads"],
+        "temp_directory": os.path.join(config["db_dir"], "tmp"),
+    }
+
+
+def ingest_sql_dataset(fingerprint, uploaded_file):
+    """把上传的 CSV 导入磁盘上的 DuckDB 数据库并返回数据库路径，相同内容只导入一次"""
+    config = SQL_ENGINE_CONFIG
+    path = os.path.join(config["db_dir"], f"{fingerprint}.duckdb")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(config["db_dir"], exist_ok=True)
+    tmp = os.path.join(config["db_dir"], uuid.uuid4().hex)
+    csv_path, db_path = f"{tmp}.csv", f"{tmp}.duckdb"
     try:
-        # 如果是新文件，处理文本
-        if st.session_state.is_new_file:
-            # 使用 HuggingFaceEmbeddings 加载模型
-            em = HuggingFaceEmbeddings(model_name="bert-base-chinese")
-
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=50,
-                separators=["\n", "。", "！", "？", "，", "、", ""]
+        copy_upload(uploaded_file, csv_path)
+        with duckdb.connect(db_path, config=duckdb_config()) as connection:
+            connection.execute(f"CREATE TABLE {SqlDataset.table} AS SELECT * FROM read_csv_auto(?)", [csv_path])
+        os.replace(db_path, path)
+    finally:
+        for leftover in (csv_path, db_path, f"{db_path}.wal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    return path
+
+
+class SqlDataset:
+    """保存在 DuckDB 中的数据集：数据留在磁盘上，只有查询结果进入内存
+
+    提供 shape 和 head()，数据预览和模型路由可以像使用 DataFrame 一样使用它。
+    """
+    table = "data"
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = get_duckdb_connection(path)
+        self.columns = self.query(f"DESCRIBE {self.table}")[["column_name", "column_type"]].values.tolist()
+        rows = self.query(f"SELECT count(*) AS n FROM {self.table}")["n"].iloc[0]
+        self.shape = (int(rows), len(self.columns))
+
+    def query(self, sql, max_rows=None):
+        """执行 SQL，最多取回 max_rows 行结果（None 表示全部）"""
+        with self._connection.cursor() as cursor:
+            cursor.execute(sql)
+            if max_rows is None:
+                return cursor.fetch_df()
+            rows = cursor.fetchmany(max_rows)
+            return pd.DataFrame(rows, columns=[d[0] for d in cursor.description or []])
+
+    def head(self, n=5):
+        return self.query(f"SELECT * FROM {self.table} LIMIT {int(n)}")
+
+    def profile_columns(self):
+        """用 DuckDB 的 SUMMARIZE 一次扫描得到各列的概况"""
+        lines = []
+        for _, row in self.query(f"SUMMARIZE {self.table}").iterrows():
+            line = f"{row['column_name']} ({row['column_type']})，缺失 {float(row['null_percentage']):.1f}%，" \
+                   f"约 {row['approx_unique']} 个不同值"
+            if row["column_type"] != "VARCHAR":
+                line += f"，范围 {format_profile_value(row['min'])} ~ {format_profile_value(row['max'])}"
+            lines.append(line)
+        return lines
+
+    def run_agent_query(self, sql):
+        """代理工具：执行 SQL 并以文本返回结果，出错时返回错误信息让代理修正"""
+        sql = sql.strip().strip("`").removeprefix("sql").strip()
+        limit = SQL_ENGINE_CONFIG["max_result_rows"]
+        try:
+            result = self.query(sql, limit + 1)
+        except duckdb.Error as e:
+            return f"SQL 执行出错: {e}"
+        note = f"\n（结果超过 {limit} 行，只显示前 {limit} 行，请在 SQL 中聚合或使用 LIMIT）" if len(result) > limit else ""
+        return result.head(limit).to_string(index=False) + note
+
+
+def create_sql_dataset_agent(model, dataset):
+    """与数据框代理相同的 ReAct 代理，工具由执行 Python 换成执行 DuckDB SQL"""
+    tool = Tool(
+        name="sql_db_query",
+        func=dataset.run_agent_query,
+        description=f"在 DuckDB 中执行一条 SQL 查询并返回结果。表名 {dataset.table}，各列及取值范围见问题中的数据概况"
+    )
+    prompt = PromptTemplate.from_template(f"{REACT_PREFIX}\n\n{{tools}}\n\n{FORMAT_INSTRUCTIONS}\n\n{REACT_SUFFIX}")
+    return AgentExecutor(
+        agent=RunnableAgent(
+            runnable=create_react_agent(model, [tool], prompt),
+            input_keys_arg=["input"],
+            return_keys_arg=["output"]
+        ),
+        tools=[tool],
+        verbose=True,
+        handle_parsing_errors=lambda _: "请按指定格式回复",
+        max_iterations=SQL_ENGINE_CONFIG["max_iterations"],
+        max_execution_time=REQUEST_DEADLINE_SECONDS
+    )
+
+
+# ============================================================
+# 数据集概况
+# ============================================================
+def format_profile_value(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    if isinstance(value, pd.Timestamp):
+        return f"{value:%Y-%m-%d}"
+    text = str(value)
+    limit = DATA_PROFILE_CONFIG["max_value_chars"]
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def profile_column(name, col):
+    """一列的概况：类型、缺失数、数值或日期范围，文本列给出不同值个数和常见取值"""
+    parts = [f"{name} ({col.dtype})"]
+    missing = len(col) - col.count()
+    if missing:
+        parts.append(f"缺失 {missing}")
+    if pd.api.types.is_bool_dtype(col):
+        pass
+    elif pd.api.types.is_numeric_dtype(col) or pd.api.types.is_datetime64_any_dtype(col):
+        if missing < len(col):
+            parts.append(f"范围 {format_profile_value(col.min())} ~ {format_profile_value(col.max())}")
+    else:
+        distinct = col.nunique(dropna=True)
+        parts.append(f"{distinct} 个不同值")
+        # 以文本保存的日期给出日期范围，提示代理先转换类型
+        sample = col.dropna().head(20).astype(str)
+        if len(sample) and pd.to_datetime(sample, errors="coerce", format="mixed").notna().mean() >= 0.9:
+            dates = pd.to_datetime(pd.Series(col.dropna().unique()).astype(str), errors="coerce", format="mixed")
+            parts.append(f"文本日期 {format_profile_value(dates.min())} ~ {format_profile_value(dates.max())}")
+        elif distinct < len(col) - missing:  # 取值各不相同时常见取值没有意义
+            top = col.value_counts().head(DATA_PROFILE_CONFIG["top_values"]).index
+            parts.append("常见取值 " + "、".join(format_profile_value(value) for value in top))
+    return "，".join(parts)
+
+
+def build_data_profile(df, token_budget, model_name):
+    """生成数据集概况：规模、各列类型和取值范围，预算允许时附带几行示例；超出预算的列只给出省略数量"""
+    rows, columns = df.shape
+    if isinstance(df, SqlDataset):
+        lines = [f"共 {rows} 行 × {columns} 列，DuckDB 表名 {df.table}。各列（类型，缺失比例，取值范围）："]
+        column_lines = df.profile_columns()
+    else:
+        lines = [f"共 {rows} 行 × {columns} 列，变量名 df。各列（类型，缺失，取值范围或常见取值）："]
+        column_lines = (profile_column(name, col) for name, col in df.items())
+
+    tokens = count_tokens(lines[0], model_name)
+    for i, line in enumerate(column_lines):
+        line = f"- {line}"
+        line_tokens = count_tokens(line, model_name) + 1
+        if tokens + line_tokens > token_budget:
+            lines.append(f"- …其余 {columns - i} 列省略")
+            break
+        lines.append(line)
+        tokens += line_tokens
+
+    for n in range(DATA_PROFILE_CONFIG["sample_rows"], 0, -1):
+        sample = f"前 {n} 行示例：\n" + df.head(n).to_string(max_colwidth=DATA_PROFILE_CONFIG["max_value_chars"])
+        if tokens + count_tokens(sample, model_name) <= token_budget:
+            lines.append(sample)
+            break
+    return "\n".join(lines)
+
+
+def get_data_profile(df):
+    """数据集概况每个数据集只计算一次，之后的问题直接复用"""
+    cached = st.session_state.get("df_profile")
+    if cached is not None and cached[0] is df:
+        return cached[1]
+    start = time.perf_counter()
+    profile = build_data_profile(df, DATA_PROFILE_CONFIG["token_budget"], st.session_state.active_model)
+    logger.info("数据集概况生成耗时 %.2fs，约 %d tokens", time.perf_counter() - start,
+                count_tokens(profile, st.session_state.active_model))
+    st.session_state.df_profile = (df, profile)
+    return profile
+
+
+# ============================================================
+# 请求限流调度
+# ============================================================
+class TokenBucket:
+    """令牌桶：容量为每分钟配额，按秒匀速补充；预约后余额可以为负，由后来者排队偿还"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """预约 amount 个令牌，返回需要等待的秒数"""
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self):
+        """服务端已返回 429：清空余额，让所有会话一起退避"""
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class RateLimitScheduler:
+    """按模型分别维护 rpm / tpm 令牌桶，请求发送前预约配额，不足时在后台线程中排队等待"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.throttled = 0
+        self.waited_seconds = 0.0
+        self.retries = 0
+        self._buckets = {}  # 模型 → (请求数令牌桶, token 令牌桶)
+        self._lock = threading.Lock()
+
+    def _get_buckets(self, model_name):
+        buckets = self._buckets.get(model_name)
+        if buckets is None:
+            limit = self.limits.get(model_name, self.limits["default"])
+            buckets = (TokenBucket(limit["rpm"]), TokenBucket(limit["tpm"]))
+            self._buckets[model_name] = buckets
+        return buckets
+
+    def admit(self, model_name, tokens, cancelled=None):
+        """为一次请求预约 1 个请求配额和 tokens 个 token 配额，必要时阻塞等待
+
+        等待期间 cancelled 被设置时退还预约的配额并抛出 RequestCancelled。
+        """
+        with self._lock:
+            requests_bucket, tokens_bucket = self._get_buckets(model_name)
+            wait_seconds = max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+            if wait_seconds > 0:
+                self.throttled += 1
+                self.waited_seconds += wait_seconds
+        if wait_seconds <= 0:
+            return
+        if cancelled is None:
+            time.sleep(wait_seconds)
+        elif cancelled.wait(wait_seconds):
+            with self._lock:
+                requests_bucket.refund(1)
+                tokens_bucket.refund(tokens)
+            raise RequestCancelled("请求已取消")
+
+    def settle(self, model_name, estimated, actual):
+        """按实际用量归还多预约的 token 配额"""
+        if actual < estimated:
+            with self._lock:
+                self._get_buckets(model_name)[1].refund(estimated - actual)
+
+    def on_rate_limited(self, model_name):
+        with self._lock:
+            for bucket in self._get_buckets(model_name):
+                bucket.drain()
+
+    def retrying(self, model_name):
+        """带随机抖动的指数退避重试；遇到 429 时同时清空该模型的令牌桶"""
+        def before_sleep(retry_state):
+            error = retry_state.outcome.exception()
+            with self._lock:
+                self.retries += 1
+            if isinstance(error, openai.RateLimitError):
+                self.on_rate_limited(model_name)
+            logger.warning("模型 %s 请求失败，第 %d 次重试: %s", model_name, retry_state.attempt_number, error)
+
+        return Retrying(
+            retry=retry_if_exception_type((
+                openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError
+            )),
+            wait=wait_random_exponential(multiplier=1, max=RATE_LIMIT_RETRY_CONFIG["max_wait"]),
+            stop=stop_after_attempt(RATE_LIMIT_RETRY_CONFIG["max_attempts"]),
+            before_sleep=before_sleep,
+            reraise=True,
+        )
+
+
+@st.cache_resource
+def get_rate_limit_scheduler():
+    """进程级共享的请求限流调度器"""
+    return RateLimitScheduler(RATE_LIMIT_CONFIG)
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """经限流调度发送请求的 ChatOpenAI
+
+    响应缓存命中的调用不会走到 _generate / _stream，因此不占用配额。
+    """
+
+    def _estimate_tokens(self, messages):
+        return count_tokens(get_buffer_string(messages), self.model_name) + \
+            (self.max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.streaming:
+            # 流式请求最终走 _stream，在那里调度，避免重复预约
+            return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        scheduler = get_rate_limit_scheduler()
+        estimated = self._estimate_tokens(messages)
+        for attempt in scheduler.retrying(self.model_name):
+            with attempt:
+                scheduler.admit(self.model_name, estimated, current_request_cancelled.get())
+                result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        if usage.get("total_tokens"):
+            scheduler.settle(self.model_name, estimated, usage["total_tokens"])
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        """只在收到第一个数据块之前重试；已经输出 token 后出错直接抛出，避免重新生成导致内容重复"""
+        scheduler = get_rate_limit_scheduler()
+        estimated = self._estimate_tokens(messages)
+        for attempt in scheduler.retrying(self.model_name):
+            with attempt:
+                scheduler.admit(self.model_name, estimated, current_request_cancelled.get())
+                chunks = super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+                first = next(chunks, None)
+        usage = None
+        for chunk in itertools.chain([first] if first is not None else [], chunks):
+            usage = chunk.message.usage_metadata or usage
+            yield chunk
+        if usage and usage.get("total_tokens"):
+            scheduler.settle(self.model_name, estimated, usage["total_tokens"])
+
+
+def render_rate_limit_stats():
+    scheduler = get_rate_limit_scheduler()
+    st.caption(f"🚦 限流：排队 {scheduler.throttled} 次，累计等待 {scheduler.waited_seconds:.1f} 秒，"
+               f"重试 {scheduler.retries} 次")
+
+
+# ============================================================
+# 大模型客户端池
+# ============================================================
+@st.cache_resource
+def get_http_client():
+    """进程级共享的 HTTP 客户端，保持长连接"""
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=LLM_HTTP_CONFIG["max_connections"],
+            max_keepalive_connections=LLM_HTTP_CONFIG["max_keepalive_connections"],
+            keepalive_expiry=LLM_HTTP_CONFIG["keepalive_expiry"],
+        ),
+        timeout=LLM_HTTP_CONFIG["timeout"],
+    )
+
+
+class LLMClientRegistry:
+    """(API Key, 接口地址, 模型, 采样参数) → ScheduledChatOpenAI 实例，以及基于这些实例构建的无状态链
+
+    所有实例共用 get_http_client() 的连接池，超出容量时淘汰最久未使用的实例。
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._models = OrderedDict()  # 参数键 → ChatOpenAI
+        self._qa_chains = {}  # (参数键, 链参数键) → 问答链
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(params):
+        return json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+
+    def chat_model(self, **params):
+        key = self._key(params)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+            # 采样温度大于 0 时每次回答本应不同，除非显式允许，否则不使用响应缓存
+            cacheable = not params.get("temperature") or LLM_RESPONSE_CACHE_CONFIG["allow_sampling"]
+            # 重试由限流调度器统一处理，关闭 openai 客户端自带的重试
+            model = ScheduledChatOpenAI(
+                http_client=get_http_client(),
+                max_retries=0,
+                cache=get_llm_response_cache() if cacheable else False,
+                **params
             )
-            texts = text_splitter.split_text(st.session_state.txt_content)
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                evicted, _ = self._models.popitem(last=False)
+                for chain_key in [k for k in self._qa_chains if k[0] == evicted]:
+                    del self._qa_chains[chain_key]
+            return model
+
+    def qa_chain(self, model, **kwargs):
+        """基于已登记模型的 "stuff" 问答链，链本身不保存状态，可以在会话之间共享"""
+        with self._lock:
+            key = next((k for k, m in self._models.items() if m is model), None)
+            chain_key = (key, self._key(kwargs))
+            chain = self._qa_chains.get(chain_key) if key is not None else None
+            if chain is None:
+                chain = load_qa_chain(model, chain_type="stuff", **kwargs)
+                if key is not None:
+                    self._qa_chains[chain_key] = chain
+            return chain
+
+
+@st.cache_resource
+def get_llm_registry():
+    return LLMClientRegistry(LLM_REGISTRY_SIZE)
+
+
+def get_chat_model(**overrides):
+    """按当前会话的 API Key 和模型配置从注册表取 ChatOpenAI，overrides 覆盖默认参数"""
+    params = {
+        "api_key": st.session_state.API_KEY,
+        "base_url": st.session_state.base_url,
+        "model": st.session_state.active_model,
+        "temperature": st.session_state.model_temperature,
+        "max_tokens": st.session_state.model_max_length,
+    }
+    params.update(overrides)
+    return get_llm_registry().chat_model(**params)
 
-            db = FAISS.from_texts(texts, em)
-            st.session_state.db = db
-            st.session_state.is_new_file = False
 
-        # 创建检索链
-        model = ChatOpenAI(
-            api_key=st.session_state.API_KEY,
-            base_url='https://twapi.openai-hk.com/v1',
-            model=st.session_state.selected_model,
-            temperature=st.session_state.model_temperature,
-            max_tokens=st.session_state.model_max_length
+# ============================================================
+# 模型路由
+# ============================================================
+def route_by_complexity(query, mode, data_shape=None):
+    """本地规则估计问题复杂度并选择模型，mode 为 chat / rag / data"""
+    config = MODEL_ROUTING_CONFIG
+    score = 0
+    if len(query) > config["long_query_chars"]:
+        score += 1
+    if COMPLEX_QUERY_PATTERN.search(query.lower()):
+        score += 1
+    if mode == "data":
+        # 图表需要严格的 JSON 输出，大数据需要更可靠的代码
+        if any(kw in query.lower() for kw in CHART_KEYWORDS):
+            score += 1
+        if data_shape and (data_shape[0] > config["large_data_rows"] or data_shape[1] > config["large_data_columns"]):
+            score += 1
+    return config["large"] if score >= config["large_score"] else config["small"]
+
+
+def choose_model(query):
+    """本次请求使用的模型：手动选择时直接使用，选择 "auto" 时按问题复杂度路由"""
+    if st.session_state.selected_model != "auto":
+        return st.session_state.selected_model
+    df = st.session_state.data_df
+    if df is not None:
+        return route_by_complexity(query, "data", df.shape)
+    return route_by_complexity(query, "rag" if st.session_state.txt_docs else "chat")
+
+
+def can_escalate():
+    """自动路由选中了小模型时，可以在输出无法解析后改用大模型"""
+    return st.session_state.selected_model == "auto" and \
+        st.session_state.active_model != MODEL_ROUTING_CONFIG["large"]
+
+
+class RouteStats:
+    """各路由（模型）的请求次数、平均耗时与升级次数，进程内所有会话共享"""
+
+    def __init__(self):
+        self.requests = {}  # 模型 → (次数, 总耗时)
+        self.escalations = 0
+        self._lock = threading.Lock()
+
+    def record(self, model_name, seconds):
+        with self._lock:
+            count, total = self.requests.get(model_name, (0, 0.0))
+            self.requests[model_name] = (count + 1, total + seconds)
+
+    def record_escalation(self):
+        with self._lock:
+            self.escalations += 1
+
+
+@st.cache_resource
+def get_route_stats():
+    return RouteStats()
+
+
+def render_route_stats():
+    stats = get_route_stats()
+    routes = "；".join(f"{model} {count} 次，平均 {total / count:.1f}s"
+                      for model, (count, total) in sorted(stats.requests.items()))
+    st.caption(f"🧭 自动路由：{routes or '暂无请求'}；升级到大模型 {stats.escalations} 次")
+
+
+# ============================================================
+# 流式输出
+# ============================================================
+class RequestCancelled(Exception):
+    """请求被用户取消、超时或被新问题取代"""
+
+
+# 当前后台线程正在执行的请求的取消标记，由 StreamingRun 设置，供限流等待时检查
+current_request_cancelled = contextvars.ContextVar("current_request_cancelled", default=None)
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    """把模型生成的 token 和代理的中间步骤放入队列，由页面线程取出显示
+
+    每个回调先检查取消标记，已取消时抛出 RequestCancelled 中断链或代理：
+    流式响应随之关闭，HTTP 连接交还连接池，代理也不会再执行下一步工具调用。
+    """
+
+    raise_error = True  # 回调中的异常要传给链，而不是只记录日志
+
+    def __init__(self, events, cancelled):
+        self.events = events
+        self.cancelled = cancelled
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            raise RequestCancelled("请求已取消")
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._check_cancelled()
+
+    def on_llm_new_token(self, token, **kwargs):
+        self._check_cancelled()
+        if token:
+            self.events.put(("token", token))
+
+    def on_agent_action(self, action, **kwargs):
+        self._check_cancelled()
+        self.events.put(("step", action.log))
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self._check_cancelled()
+
+    def on_tool_end(self, output, **kwargs):
+        self._check_cancelled()
+        self.events.put(("observation", str(output)))
+
+
+@st.cache_resource
+def get_stream_executor():
+    """进程级共享的模型调用线程池"""
+    return ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="llm-stream")
+
+
+class StreamingRun:
+    """在后台线程中执行一次模型调用，页面线程通过 events()/tokens() 逐条取出输出
+
+    fn 接收回调列表并返回最终结果，回调需要传给链或代理的 config，后台线程中不能调用 st.*。
+    页面线程等待期间定期调用 heartbeat(已等待秒数)，让 Streamlit 有机会响应停止按钮和新问题；
+    超过 timeout 秒或调用 cancel() 后，后台调用会在下一个回调处中断。
+    """
+
+    def __init__(self, fn, timeout=None, heartbeat=None):
+        self.started = time.perf_counter()
+        self.first_output_at = None
+        self.result = None
+        self.error = None
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self._events = queue.Queue()
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._future = get_stream_executor().submit(self._run, fn)
+
+    def _run(self, fn):
+        token = current_request_cancelled.set(self._cancelled)
+        try:
+            self.result = fn([QueueCallbackHandler(self._events, self._cancelled)])
+        except Exception as e:
+            self.error = e
+        finally:
+            current_request_cancelled.reset(token)
+            self._done.set()
+            self._events.put(("done", None))
+
+    def cancel(self):
+        """取消调用；尚未开始执行的调用直接从线程池队列中移除"""
+        self._cancelled.set()
+        self._future.cancel()
+
+    def is_finished(self):
+        return self._done.is_set() or self._future.cancelled()
+
+    def events(self):
+        """依次产出 (类型, 内容)，类型为 token / step / observation，调用结束时停止"""
+        try:
+            while True:
+                elapsed = time.perf_counter() - self.started
+                if self.timeout and elapsed > self.timeout:
+                    self.cancel()
+                    raise TimeoutError(f"请求超过 {self.timeout} 秒仍未完成，已取消")
+                try:
+                    kind, payload = self._events.get(timeout=0.5)
+                except queue.Empty:
+                    if self.heartbeat is not None:
+                        self.heartbeat(elapsed)
+                    continue
+                if kind == "done":
+                    break
+                if self.first_output_at is None:
+                    self.first_output_at = time.perf_counter()
+                yield kind, payload
+        finally:
+            # 页面被新问题或停止按钮打断时，后台调用随之取消
+            if not self.is_finished():
+                self.cancel()
+        if self.heartbeat is not None:
+            self.heartbeat(None)
+
+    def tokens(self):
+        """只产出模型 token，供 st.write_stream 使用"""
+        for kind, payload in self.events():
+            if kind == "token":
+                yield payload
+
+    def wait(self):
+        """等待调用结束并返回结果，调用出错时在页面线程重新抛出"""
+        if self._cancelled.is_set():
+            raise RequestCancelled("请求已取消")
+        self._future.result()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def time_to_first_output(self):
+        return None if self.first_output_at is None else self.first_output_at - self.started
+
+
+def cancel_active_request(reason=None):
+    """取消本会话正在进行的请求；reason 不为空时在对话中记录一条说明"""
+    run = st.session_state.get("active_request")
+    st.session_state.active_request = None
+    if run is not None and not run.is_finished():
+        run.cancel()
+        if reason:
+            st.session_state.current_session_messages.append({'role': 'ai', 'content': reason})
+
+
+def start_request(fn):
+    """以本会话当前请求的身份启动一次后台调用，同一会话之前未完成的请求先被取消"""
+    cancel_active_request()
+    waiting = st.empty()
+
+    def show_waiting(elapsed):
+        if elapsed is None:
+            waiting.empty()
+        elif elapsed >= 2:
+            waiting.caption(f"⏳ 已等待 {elapsed:.0f} 秒...")
+
+    run = StreamingRun(fn, timeout=REQUEST_DEADLINE_SECONDS, heartbeat=show_waiting)
+    st.session_state.active_request = run
+    return run
+
+
+# ============================================================
+# 代理代码执行子进程
+# ============================================================
+class PythonSandbox:
+    """在独立子进程中执行数据分析代理生成的 Python 代码
+
+    代码超时、请求被取消时直接终止子进程，CPU 和模型调用线程立即释放，下次执行时重新启动子进程。
+    数据框来自 Arrow 缓存时子进程自行内存映射读取，与页面进程共享文件页面；否则启动时发送一份。
+    """
+
+    def __init__(self, df, cache_path, timeout):
+        self.df = df
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self._conn is not None:
+            self._conn.close()
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=process_workers.python_repl_worker, args=(child_conn, self.cache_path),
+            name="python-sandbox", daemon=True
         )
+        self._process.start()
+        child_conn.close()
+        if self.cache_path is None:
+            self._conn.send(self.df)
+
+    def start(self):
+        """提前启动子进程，与模型生成第一步并行完成启动和导入"""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+
+    def run(self, code, cancelled=None):
+        """执行代码并返回输出文本；cancelled 被设置时终止子进程并抛出 RequestCancelled"""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+            process, conn = self._process, self._conn
+            conn.send(code)
+            deadline = time.monotonic() + self.timeout
+            while not conn.poll(0.2):
+                if cancelled is not None and cancelled.is_set():
+                    process.kill()
+                    raise RequestCancelled("请求已取消")
+                if time.monotonic() > deadline:
+                    process.kill()
+                    return f"TimeoutError: 代码执行超过 {self.timeout} 秒，已终止，请改用更简单的计算"
+            try:
+                return conn.recv()
+            except EOFError:
+                return "Error: 执行代码的子进程已退出"
 
-        retriever = st.session_state.db.as_retriever()
+    def stop(self):
+        """终止子进程，不等待正在执行的代码"""
+        if self._process is not None and self._process.is_alive():
+            self._process.kill()
 
-        # 显式加载聊天历史
-        chat_history = st.session_state.memory.load_memory_variables({})["history"]
 
-        chain = ConversationalRetrievalChain.from_llm(
-            llm=model,
-            retriever=retriever,
-            return_source_documents=True
+class SandboxedPythonTool(BaseTool):
+    """替换 pandas 代理自带的 python_repl_ast 工具，代码在 PythonSandbox 子进程中执行"""
+    name: str = "python_repl_ast"
+    description: str = ""
+    _sandbox = PrivateAttr(default=None)
+
+    def bind(self, sandbox):
+        self._sandbox = sandbox
+
+    def _run(self, query, run_manager=None):
+        # 本次请求的取消标记在 StreamingRun 传入的回调中
+        handlers = run_manager.handlers if run_manager is not None else []
+        cancelled = next((h.cancelled for h in handlers if isinstance(h, QueueCallbackHandler)), None)
+        return self._sandbox.run(query, cancelled)
+
+
+def dataset_cache_path(df):
+    """df 是从 Arrow 缓存读取的当前数据时返回缓存文件路径"""
+    parse = st.session_state.get("data_parse")
+    if parse is None or parse["data"]["df"] is not df:
+        return None
+    return parse["data"].get("path")
+
+
+def release_df_agent():
+    """丢弃缓存的数据分析代理，并终止其执行代码的子进程"""
+    agents = st.session_state.get("df_agent")
+    if agents is not None and agents[2] is not None:
+        agents[2].stop()
+    st.session_state.df_agent = None
+
+
+def reset_data_state():
+    """没有选中数据文件时（例如只剩 TXT 文件）清空数据分析相关的全部状态"""
+    st.session_state.data_df = None
+    st.session_state.data_parse = None
+    st.session_state.df_profile = None
+    release_df_agent()  # 释放代理持有的旧数据和子进程
+
+
+# ============================================================
+# 共享嵌入模型
+# ============================================================
+class SharedEmbeddings(Embeddings):
+    """进程内所有会话共用的嵌入模型
+
+    HuggingFace 快速分词器不支持多线程并发调用，编码时串行化；
+    模型本身只加载一份，不再随会话数量增长。
+    """
+
+    def __init__(self, embeddings):
+        self._embeddings = embeddings
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self._lock:
+            return self._embeddings.embed_query(text)
+
+
+@st.cache_resource(show_spinner="正在加载嵌入模型...")
+def get_embedding_model():
+    """加载并预热嵌入模型，整个进程只执行一次"""
+    em = HuggingFaceEmbeddings(**EMBEDDING_CONFIG)
+    # 预热：完成分词器初始化和首次前向计算，避免首个问题承担这部分延迟
+    em.embed_query("预热")
+    return SharedEmbeddings(em)
+
+
+@st.cache_resource
+def start_embedding_warmup():
+    """服务启动后的第一次运行即在后台加载嵌入模型，不阻塞页面渲染"""
+    thread = threading.Thread(target=get_embedding_model, name="embedding-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+# ============================================================
+# 向量索引类型
+# ============================================================
+def create_faiss_index(dim, expected_chunks, config=None):
+    """按预计文本块数量选择索引类型：小文档用精确的 flat 索引，大文档用 HNSW 或 IVF 近似索引；
+    可选用 int8 标量量化或乘积量化压缩向量，降低每个会话的索引内存"""
+    config = {**VECTOR_INDEX_CONFIG, **(config or {})}
+    mode = config["mode"]
+    if mode == "auto":
+        mode = "flat" if expected_chunks <= config["flat_max_chunks"] else config["large_mode"]
+    quantization = config["quantization"]
+    sq_type = faiss.ScalarQuantizer.QT_8bit
+    # 子向量个数必须整除向量维度
+    pq_m = math.gcd(dim, config["pq_m"])
+    pq_nbits = config["pq_nbits"]
+
+    if mode == "hnsw":
+        if quantization == "sq8":
+            index = faiss.IndexHNSWSQ(dim, sq_type, config["hnsw_m"])
+        elif quantization == "pq":
+            index = faiss.IndexHNSWPQ(dim, pq_m, config["hnsw_m"], pq_nbits)
+        else:
+            index = faiss.IndexHNSWFlat(dim, config["hnsw_m"])
+        index.hnsw.efConstruction = config["hnsw_ef_construction"]
+    elif mode == "ivf":
+        nlist = config["ivf_nlist"] or max(1, int(4 * math.sqrt(expected_chunks)))
+        if quantization == "sq8":
+            index = faiss.IndexIVFScalarQuantizer(faiss.IndexFlatL2(dim), dim, nlist, sq_type)
+        elif quantization == "pq":
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, pq_m, pq_nbits)
+        else:
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+    else:
+        if quantization == "sq8":
+            index = faiss.IndexScalarQuantizer(dim, sq_type)
+        elif quantization == "pq":
+            index = faiss.IndexPQ(dim, pq_m, pq_nbits)
+        else:
+            index = faiss.IndexFlatL2(dim)
+    apply_search_params(index)
+    return index
+
+
+def apply_search_params(index, config=None):
+    """设置近似索引的查询参数（faiss 不一定随索引文件保存这些参数，加载后需要重新设置）"""
+    config = {**VECTOR_SEARCH_CONFIG, **(config or {})}
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config["hnsw_ef_search"]
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = config["ivf_nprobe"]
+
+
+def is_quantized(index):
+    """索引中保存的是否为压缩后的向量"""
+    return not isinstance(index, (faiss.IndexFlat, faiss.IndexHNSWFlat, faiss.IndexIVFFlat))
+
+
+def training_size(index):
+    """返回索引训练的 (建议样本数, 最少样本数)，无需训练的索引返回 (0, 0)"""
+    if index.is_trained:
+        return 0, 0
+    minimum = 1
+    if isinstance(index, faiss.IndexIVF):
+        minimum = max(minimum, index.nlist)
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ, faiss.IndexHNSWPQ)):
+        minimum = max(minimum, 2 ** VECTOR_INDEX_CONFIG["pq_nbits"])
+    # faiss 的聚类建议每个中心至少 39 个样本
+    return max(minimum * 39, 1000), minimum
+
+
+def rerank_exact(query_embedding, results, k):
+    """用嵌入缓存中的原始向量对压缩索引的候选结果做精确重排，返回 [(文本块, 精确距离)]"""
+    cache = get_embedding_cache()
+    hashes = [cache.chunk_hash(doc.page_content) for doc, _ in results]
+    vectors = cache.get_many(hashes)
+    query = np.asarray(query_embedding, dtype=np.float32)
+
+    reranked = []
+    for (doc, approx_distance), chunk_hash in zip(results, hashes):
+        vector = vectors.get(chunk_hash)
+        # 缓存中缺失的向量沿用近似距离
+        distance = float(np.sum((vector - query) ** 2)) if vector is not None else float(approx_distance)
+        reranked.append((doc, distance))
+    reranked.sort(key=lambda item: item[1])
+    return reranked[:k]
+
+
+def create_vector_store(embeddings, dim, expected_chunks):
+    """创建空的 LangChain FAISS 向量库，底层索引类型由文档规模决定"""
+    return FAISS(
+        embedding_function=embeddings,
+        index=create_faiss_index(dim, expected_chunks),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={}
+    )
+
+
+# ============================================================
+# 向量索引缓存
+# ============================================================
+def index_cache_key(fingerprint):
+    """根据文档指纹和分块/嵌入/索引配置生成索引缓存键，任一配置变化都会产生新的键"""
+    config = json.dumps(
+        {"embedding": EMBEDDING_CONFIG, "splitter": TEXT_SPLITTER_CONFIG, "index": VECTOR_INDEX_CONFIG},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(f"{fingerprint}:{config}".encode("utf-8")).hexdigest()
+
+
+def load_cached_index(cache_key, embeddings):
+    """从磁盘加载已构建的索引，未命中时返回 None"""
+    index_dir = os.path.join(INDEX_CACHE_DIR, cache_key)
+    if not os.path.exists(os.path.join(index_dir, "index.faiss")):
+        return None
+    try:
+        # 缓存目录只由本应用写入，可以安全反序列化
+        db = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+        apply_search_params(db.index)
+        return db
+    except Exception as e:
+        logger.warning("索引缓存读取失败，将重新构建: %s", e)
+        return None
+
+
+def save_index_to_cache(cache_key, db):
+    """将索引写入磁盘缓存（先写临时目录再重命名，避免并发会话读到半成品）"""
+    index_dir = os.path.join(INDEX_CACHE_DIR, cache_key)
+    tmp_dir = f"{index_dir}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        db.save_local(tmp_dir)
+    except Exception as e:
+        logger.warning("索引缓存写入失败: %s", e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        # 其他会话已写入同一索引，保留先写入的版本
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class ChunkEmbeddingCache:
+    """文本块嵌入缓存：块文本哈希 → 向量，持久化在 SQLite 中，进程内所有会话共享"""
+
+    def __init__(self, db_path, model_key):
+        self.model_key = model_key
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_embeddings ("
+            "model TEXT NOT NULL, chunk_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, chunk_hash))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def chunk_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, hashes):
+        """批量读取向量，返回 {哈希: 向量}"""
+        found = {}
+        hashes = list(hashes)
+        with self._lock:
+            # SQLite 单条语句的参数个数有限，分批查询
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT chunk_hash, vector FROM chunk_embeddings "
+                    f"WHERE model = ? AND chunk_hash IN ({','.join('?' * len(batch))})",
+                    [self.model_key, *batch]
+                ).fetchall()
+                for chunk_hash, blob in rows:
+                    found[chunk_hash] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        """批量写入 (哈希, 向量)"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (model, chunk_hash, vector) VALUES (?, ?, ?)",
+                [(self.model_key, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in items]
+            )
+            self._conn.commit()
+
+    def record(self, hits, misses):
+        """累加命中/未命中计数"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@st.cache_resource
+def get_embedding_cache():
+    """进程级共享的文本块嵌入缓存"""
+    model_key = json.dumps(EMBEDDING_CONFIG, sort_keys=True, ensure_ascii=False)
+    return ChunkEmbeddingCache(EMBEDDING_CACHE_PATH, model_key)
+
+
+# ============================================================
+# 语义回答缓存
+# ============================================================
+def question_terms(question):
+    """问题的关键词集合：数字、英文词和除虚词外的每个汉字
+
+    向量相似度分不清只差一个数字或实体的问题，命中前要求关键词集合完全一致；
+    只调换语序或增减虚词的问题仍然可以命中。
+    """
+    return frozenset(term for term in QUESTION_TERM_PATTERN.findall(question.lower())
+                     if term not in QUESTION_FILLER_CHARS)
+
+
+class SemanticAnswerCache:
+    """语义回答缓存：(作用域, 问题向量) → 回答，进程内所有会话共享
+
+    作用域区分模型、生成参数和所检索的文档，只有同一作用域内足够相似且关键词一致的问题才会命中。
+    问题向量本身也做 LRU 缓存，重复提问不必再次计算嵌入。
+    """
+
+    def __init__(self, similarity_threshold, ttl_seconds, max_entries, query_embedding_cache_size):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.query_embedding_cache_size = query_embedding_cache_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # 编号 → (作用域, 归一化问题向量, 回答, 写入时间, 问题关键词)
+        self._query_vectors = OrderedDict()  # 问题文本 → 归一化问题向量
+        self._lock = threading.Lock()
+
+    def embed_question(self, question):
+        """返回归一化后的问题向量，优先使用缓存"""
+        question = question.strip()
+        with self._lock:
+            vector = self._query_vectors.get(question)
+            if vector is not None:
+                self._query_vectors.move_to_end(question)
+                return vector
+
+        vector = np.asarray(get_embedding_model().embed_query(question), dtype=np.float32)
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        with self._lock:
+            self._query_vectors[question] = vector
+            while len(self._query_vectors) > self.query_embedding_cache_size:
+                self._query_vectors.popitem(last=False)
+        return vector
+
+    def lookup(self, scope, question):
+        """查找同一作用域中关键词一致且最相似的已缓存问题，相似度达到阈值时返回其回答，否则返回 None"""
+        vector = self.embed_question(question)
+        terms = question_terms(question)
+        with self._lock:
+            self._evict_expired()
+            best_key, best_similarity = None, self.similarity_threshold
+            for key, (entry_scope, entry_vector, _, _, entry_terms) in self._entries.items():
+                if entry_scope != scope or entry_terms != terms:
+                    continue
+                similarity = float(np.dot(vector, entry_vector))
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][2]
+
+    def store(self, scope, question, answer):
+        vector = self.embed_question(question)
+        with self._lock:
+            self._entries[uuid.uuid4().hex] = (scope, vector, answer, time.time(), question_terms(question))
+            self._evict_expired()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _evict_expired(self):
+        # 调用方已持有锁
+        deadline = time.time() - self.ttl_seconds
+        for key in [key for key, entry in self._entries.items() if entry[3] < deadline]:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@st.cache_resource
+def get_answer_cache():
+    """进程级共享的语义回答缓存"""
+    return SemanticAnswerCache(**ANSWER_CACHE_CONFIG)
+
+
+def generation_scope():
+    """回答缓存作用域中的生成参数：实际使用的模型（自动路由时为路由结果）、温度和最大长度"""
+    return st.session_state.active_model, st.session_state.model_temperature, st.session_state.model_max_length
+
+
+def render_cache_stats():
+    cache = get_answer_cache()
+    st.caption(f"💡 语义缓存：命中率 {cache.hit_rate():.0%}（命中 {cache.hits} 次，"
+               f"未命中 {cache.misses} 次，缓存 {len(cache)} 条回答）")
+    response_cache = get_llm_response_cache()
+    st.caption(f"🗄️ 响应缓存：命中率 {response_cache.hit_rate():.0%}（命中 {response_cache.hits} 次，"
+               f"未命中 {response_cache.misses} 次，缓存 {response_cache.size()} 条响应）")
+
+
+# ============================================================
+# 模型响应缓存
+# ============================================================
+class LLMResponseCache(BaseCache):
+    """精确匹配的模型响应缓存，持久化在 SQLite 中，进程内所有会话共享
+
+    缓存键是 (完整提示词, 模型及采样参数) 的规范化哈希；响应用 orjson 序列化。
+    """
+
+    def __init__(self, path, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_responses_accessed ON llm_responses (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def _key(prompt, llm_string):
+        return hashlib.sha256(orjson.dumps([prompt, llm_string])).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        key = self._key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now - self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        try:
+            return [load(generation) for generation in orjson.loads(row[0])]
+        except Exception as e:
+            logger.warning("模型响应缓存读取失败: %s", e)
+            return None
+
+    def update(self, prompt, llm_string, return_val):
+        key = self._key(prompt, llm_string)
+        value = orjson.dumps([dumpd(generation) for generation in return_val])
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # 删除过期条目，超出容量时淘汰最久未使用的条目
+            self._conn.execute("DELETE FROM llm_responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM llm_responses WHERE key IN ("
+                "SELECT key FROM llm_responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_responses")
+            self._conn.commit()
+
+    def size(self):
+        # 不定义 __len__：LangChain 用真值判断是否启用缓存，空缓存不能被当成 False
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM llm_responses").fetchone()[0]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@st.cache_resource
+def get_llm_response_cache():
+    """进程级共享的模型响应缓存"""
+    config = LLM_RESPONSE_CACHE_CONFIG
+    return LLMResponseCache(config["path"], config["ttl_seconds"], config["max_entries"])
+
+
+# ============================================================
+# 上下文打包
+# ============================================================
+@st.cache_resource
+def get_token_encoding(model_name):
+    """模型对应的 tiktoken 编码，未知模型使用 cl100k_base；编码文件无法加载时返回 None"""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("tiktoken 编码加载失败，改为按字符数估算 token: %s", e)
+        return None
+
+
+def count_tokens(text, model_name):
+    encoding = get_token_encoding(model_name)
+    # 中文大致一个字符一个 token，按字符数估算只会偏多
+    return len(encoding.encode(text)) if encoding is not None else len(text)
+
+
+def strip_chunk_overlap(text, selected_texts):
+    """去掉 text 与已选文本块首尾重叠的部分；完全被已选文本块包含时返回空串
+
+    相邻文本块最多共享 chunk_overlap 个字符，同一段文字不必在提示词中出现两次。
+    """
+    max_overlap = TEXT_SPLITTER_CONFIG["chunk_overlap"]
+    min_overlap = CONTEXT_PACKING_CONFIG["min_overlap_chars"]
+    for selected in selected_texts:
+        if text in selected:
+            return ""
+        # 已选块在前：text 的开头与其结尾重叠
+        for size in range(min(max_overlap, len(selected), len(text)), min_overlap - 1, -1):
+            if selected.endswith(text[:size]):
+                text = text[size:]
+                break
+        # 已选块在后：text 的结尾与其开头重叠
+        for size in range(min(max_overlap, len(selected), len(text)), min_overlap - 1, -1):
+            if selected.startswith(text[-size:]):
+                text = text[:-size]
+                break
+    return text.strip()
+
+
+def pack_context(docs, token_budget, model_name, baseline_k=CONTEXT_PACKING_CONFIG["baseline_k"]):
+    """按相关度顺序把文本块装入 token 预算，返回装入的文本块和统计信息
+
+    docs 已按相关度从高到低排列；装不下的文本块跳过，继续尝试后面更短的块。
+    baseline_tokens 是不打包时直接使用前 baseline_k 个文本块的 token 数，token_delta 为打包后相对它的变化。
+    """
+    candidate_tokens = 0
+    baseline_tokens = 0
+    packed_tokens = 0
+    packed = []
+    selected_by_source = {}
+
+    for i, doc in enumerate(docs):
+        doc_tokens = count_tokens(doc.page_content, model_name)
+        candidate_tokens += doc_tokens
+        if i < baseline_k:
+            baseline_tokens += doc_tokens
+        source = doc.metadata.get("source")
+        text = strip_chunk_overlap(doc.page_content, selected_by_source.get(source, []))
+        if not text:
+            continue
+        tokens = count_tokens(text, model_name)
+        if packed_tokens + tokens > token_budget:
+            continue
+        packed_tokens += tokens
+        selected_by_source.setdefault(source, []).append(doc.page_content)
+        packed.append(Document(page_content=text, metadata=doc.metadata))
+
+    return packed, {
+        "candidates": len(docs),
+        "packed": len(packed),
+        "candidate_tokens": candidate_tokens,
+        "packed_tokens": packed_tokens,
+        "baseline_tokens": baseline_tokens,
+        "token_delta": packed_tokens - baseline_tokens,
+    }
+
+
+# ============================================================
+# 对话记忆
+# ============================================================
+class TokenWindowMemory(ConversationBufferMemory):
+    """按 token 计数的滑动窗口记忆：超出上限时从最早的一轮对话开始丢弃"""
+    max_token_limit: int = MEMORY_CONFIG["max_tokens"]
+    model_name: str = "gpt-4o-mini"
+
+    def history_tokens(self):
+        return count_tokens(get_buffer_string(self.chat_memory.messages), self.model_name)
+
+    def prune(self):
+        # 成对丢弃问题和回答，至少保留最近一轮
+        messages = self.chat_memory.messages
+        while len(messages) > 2 and self.history_tokens() > self.max_token_limit:
+            del messages[:2]
+
+    def save_context(self, inputs, outputs):
+        super().save_context(inputs, outputs)
+        self.prune()
+
+
+class RollingSummaryMemory(ConversationBufferMemory):
+    """滚动摘要记忆：历史超出上限时，在后台把较早的对话并入摘要，只保留最近的对话原文
+
+    save_context 在模型调用的后台线程中执行，摘要在单独的线程池中生成，不阻塞当前回答；
+    摘要完成前的一两轮对话会暂时超出上限。摘要作为系统消息放在对话历史最前面。
+    """
+    max_token_limit: int = MEMORY_CONFIG["max_tokens"]
+    keep_tokens: int = MEMORY_CONFIG["summary_keep_tokens"]
+    model_name: str = "gpt-4o-mini"
+    summary: str = ""
+    _llm = PrivateAttr(default=None)
+    _executor = PrivateAttr(default=None)
+    _pending = PrivateAttr(default=None)
+    _lock = PrivateAttr(default_factory=threading.Lock)
+
+    def bind(self, llm, executor):
+        """设置生成摘要的模型和线程池（需要在页面脚本线程中创建，后台线程无法读取会话状态）"""
+        self._llm = llm
+        self._executor = executor
+
+    def history_tokens(self):
+        with self._lock:
+            messages = list(self.chat_memory.messages)
+        return count_tokens(self.summary + get_buffer_string(messages), self.model_name)
+
+    def load_memory_variables(self, inputs):
+        with self._lock:
+            messages = list(self.chat_memory.messages)
+            summary = self.summary
+        if summary:
+            messages = [SystemMessage(content=summary)] + messages
+        return {self.memory_key: messages if self.return_messages else get_buffer_string(messages)}
+
+    def save_context(self, inputs, outputs):
+        with self._lock:
+            super().save_context(inputs, outputs)
+        self.schedule_summary()
+
+    def schedule_summary(self):
+        if self._llm is None or self._executor is None or self.history_tokens() <= self.max_token_limit:
+            return
+        with self._lock:
+            if self._pending is not None and not self._pending.done():
+                return
+            # 从最早的对话开始成对并入摘要，直到剩余部分不超过 keep_tokens，至少保留最近一轮
+            messages = list(self.chat_memory.messages)
+            folded = 0
+            while len(messages) - folded > 2 and \
+                    count_tokens(get_buffer_string(messages[folded:]), self.model_name) > self.keep_tokens:
+                folded += 2
+            if not folded:
+                return
+            self._pending = self._executor.submit(self._summarize, self.summary, messages[:folded])
+
+    def _summarize(self, summary, messages):
+        try:
+            prompt = SUMMARY_PROMPT.format(summary=summary, new_lines=get_buffer_string(messages))
+            new_summary = self._llm.invoke(prompt).content.strip()
+        except Exception as e:
+            logger.warning("对话摘要生成失败，下一轮对话后重试: %s", e)
+            return
+        # 期间只会在末尾追加新对话，被摘要的仍是最前面的这些消息
+        with self._lock:
+            self.summary = new_summary
+            del self.chat_memory.messages[:len(messages)]
+
+
+def memory_class(strategy):
+    return {"window": TokenWindowMemory, "summary": RollingSummaryMemory}.get(strategy, ConversationBufferMemory)
+
+
+def create_memory(strategy, messages=None):
+    """按策略创建对话记忆，切换策略时沿用已有的对话消息（滚动摘要不保留）"""
+    memory = memory_class(strategy)(return_messages=True)
+    memory.chat_memory.messages.extend(messages or [])
+    return memory
+
+
+@st.cache_resource
+def get_summary_executor():
+    """进程级共享的对话摘要线程池"""
+    return ThreadPoolExecutor(max_workers=MEMORY_CONFIG["summary_workers"], thread_name_prefix="memory-summary")
+
+
+def sync_memory_strategy():
+    """侧边栏切换策略后，用新策略的记忆替换本会话的记忆"""
+    memory = st.session_state.memory
+    if type(memory) is not memory_class(st.session_state.memory_strategy):
+        memory = create_memory(st.session_state.memory_strategy, list(memory.chat_memory.messages))
+        st.session_state.memory = memory
+    return memory
+
+
+def get_conversation_memory():
+    """本会话的对话记忆，在调用模型前于页面脚本线程中调用，使记忆与侧边栏选择的策略和当前模型保持一致"""
+    memory = sync_memory_strategy()
+    if isinstance(memory, (TokenWindowMemory, RollingSummaryMemory)):
+        memory.model_name = st.session_state.active_model
+    if isinstance(memory, TokenWindowMemory):
+        memory.prune()
+    elif isinstance(memory, RollingSummaryMemory):
+        memory.bind(
+            get_chat_model(model=MEMORY_CONFIG["summary_model"], temperature=0, max_tokens=None),
+            get_summary_executor()
+        )
+        memory.schedule_summary()
+    return memory
+
+
+def render_memory_stats():
+    """在侧边栏显示下次请求携带的对话历史长度"""
+    memory = sync_memory_strategy()
+    history = memory.load_memory_variables({})[memory.memory_key]
+    text = get_buffer_string(history) if isinstance(history, list) else history
+    tokens = count_tokens(text, st.session_state.active_model)
+    if st.session_state.memory_strategy == "buffer":
+        st.caption(f"对话历史约 {tokens} tokens")
+    else:
+        st.caption(f"对话历史约 {tokens} / {MEMORY_CONFIG['max_tokens']} tokens")
+
+
+# ============================================================
+# 流式嵌入流水线
+# ============================================================
+@st.cache_resource
+def get_embedding_pool():
+    """进程级共享的嵌入进程池，每个子进程持有一份模型，合计用满全部 CPU 核心"""
+    workers = EMBED_PIPELINE_CONFIG["workers"]
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        # 主进程已加载 torch 并启动了多个线程，fork 不安全
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=process_workers.init_embedding_worker,
+        initargs=(
+            EMBEDDING_CONFIG["model_name"],
+            EMBEDDING_CONFIG.get("model_kwargs", {}),
+            EMBEDDING_CONFIG.get("encode_kwargs", {}),
+            max(1, (os.cpu_count() or 1) // workers),
+        )
+    )
+
+
+def embed_chunks(texts, embeddings):
+    """生成器：逐批产出 (文本块列表, 向量列表)
+
+    先从嵌入缓存取出已有向量，其余文本块按模型最优批大小切分后提交到进程池并行编码，
+    哪一批先完成就先产出，调用方可以边接收边写入索引。
+    """
+    cache = get_embedding_cache()
+    unique_texts = list(dict.fromkeys(texts))
+    hashes = [cache.chunk_hash(t) for t in unique_texts]
+    cached = cache.get_many(hashes)
+
+    hits = [(t, cached[h]) for t, h in zip(unique_texts, hashes) if h in cached]
+    missing_texts = [t for t, h in zip(unique_texts, hashes) if h not in cached]
+    cache.record(len(hits), len(missing_texts))
+    if hits:
+        hit_texts, hit_vectors = zip(*hits)
+        yield list(hit_texts), list(hit_vectors)
+
+    batch_size = EMBED_PIPELINE_CONFIG["batch_size"]
+    batches = [missing_texts[i:i + batch_size] for i in range(0, len(missing_texts), batch_size)]
+
+    # 只有一批时启动进程池得不偿失，直接使用主进程中的共享模型
+    if len(batches) <= 1:
+        for batch in batches:
+            vectors = embeddings.embed_documents(batch)
+            cache.put_many(zip(map(cache.chunk_hash, batch), vectors))
+            yield batch, vectors
+        return
+
+    pool = get_embedding_pool()
+    batch_iter = iter(batches)
+    # 限制在途批次数量，避免已编码但未写入索引的向量堆积在内存中
+    max_in_flight = EMBED_PIPELINE_CONFIG["workers"] * 2
+    pending = {
+        pool.submit(process_workers.encode_batch, batch, batch_size): batch
+        for batch in itertools.islice(batch_iter, max_in_flight)
+    }
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                vectors = future.result()
+                cache.put_many(zip(map(cache.chunk_hash, batch), vectors))
+                yield batch, vectors
+
+                next_batch = next(batch_iter, None)
+                if next_batch is not None:
+                    pending[pool.submit(process_workers.encode_batch, next_batch, batch_size)] = next_batch
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# ============================================================
+# 后台索引任务
+# ============================================================
+class IndexingJob:
+    """单个文档的后台索引任务，建立过程中已写入的文本块即可被检索"""
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.db = None
+        self.done = 0
+        self.bytes_done = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.error = None
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = []  # IVF 索引训练前暂存的 (文本块, 向量)
+
+    def run(self, path):
+        try:
+            em = get_embedding_model()
+            self.size = os.path.getsize(path)
+
+            # 相同内容、相同配置的文档直接复用磁盘上的索引
+            cache_key = index_cache_key(self.fingerprint)
+            db = load_cached_index(cache_key, em)
+            if db is not None:
+                with self._lock:
+                    self.db = db
+                    self.done = len(db.index_to_docstore_id)
+                    self.bytes_done = self.size
+                return
+
+            # 按段读取、切分和嵌入，任何时刻内存中只有一段文本
+            text_splitter = RecursiveCharacterTextSplitter(**TEXT_SPLITTER_CONFIG)
+            cache = get_embedding_cache()
+            hits_before, misses_before = cache.hits, cache.misses
+            for segment, bytes_read in iter_text_segments(path):
+                texts = text_splitter.split_text(segment)
+                # 修改过的文档只需计算新增或变化的文本块，其余由多进程流水线编码后追加到同一个索引
+                for batch, vectors in embed_chunks(texts, em):
+                    if self.db is None:
+                        # 按第一段的切分结果估算全文块数，据此选择索引类型
+                        expected_chunks = len(texts) * self.size / max(bytes_read, 1)
+                        self.db = create_vector_store(em, len(vectors[0]), expected_chunks)
+                    self._add(list(zip(batch, vectors)))
+                self.bytes_done = bytes_read
+            self._add([], flush=True)
+            self.hits = cache.hits - hits_before
+            self.misses = cache.misses - misses_before
+
+            if self.db is None or self.done == 0:
+                raise ValueError("文档中没有可索引的文本内容")
+            save_index_to_cache(cache_key, self.db)
+        except Exception as e:
+            logger.exception("文档索引失败")
+            self.error = e
+        finally:
+            self.finished.set()
+
+    def _add(self, pairs, flush=False):
+        """写入向量；需要训练的索引（IVF、量化）先暂存向量，攒够训练样本（或文档读完）后训练再写入"""
+        index = self.db.index if self.db is not None else None
+        required, minimum = training_size(index) if index is not None else (0, 0)
+        if required:
+            self._pending.extend(pairs)
+            if len(self._pending) < required and not flush:
+                return
+            pairs, self._pending = self._pending, []
+            if not pairs:
+                return
+            training = np.array([vector for _, vector in pairs], dtype=np.float32)
+            if len(training) < minimum:
+                # 文档实际规模远小于估算，样本不足以训练，退回精确索引
+                self.db.index = faiss.IndexFlatL2(index.d)
+            else:
+                index.train(training)
+        if not pairs:
+            return
+        # FAISS 索引不支持边写边查，写入时与检索互斥
+        with self._lock:
+            self.db.add_embeddings(pairs)
+            self.done += len(pairs)
+
+    def progress(self):
+        return min(self.bytes_done / self.size, 1.0) if self.size else 0.0
+
+    def search_by_vector(self, embedding, k):
+        """返回 [(文本块, 距离)]，距离均为 L2 平方，可以在不同文档分片之间直接比较"""
+        if self.db is None or self.done == 0:
+            return []
+        rerank_factor = VECTOR_SEARCH_CONFIG["rerank_factor"]
+        rerank = rerank_factor and is_quantized(self.db.index)
+        with self._lock:
+            results = self.db.similarity_search_with_score_by_vector(
+                embedding, k=k * rerank_factor if rerank else k
+            )
+        # 压缩索引先多取候选，再用原始向量精确重排
+        return rerank_exact(embedding, results, k) if rerank else results
+
+
+class CorpusRetriever(BaseRetriever):
+    """文档库检索器：查询向量只计算一次，在线程池中并行检索各文档分片后合并 top-k
+
+    索引尚未完成的分片检索已写入的部分；设置 token_budget 时再对结果做上下文打包。
+    """
+
+    shards: list  # [(文档名, IndexingJob)]
+    search_kwargs: dict = {}
+    token_budget: int = 0  # 大于 0 时按 token 预算打包检索结果
+    model_name: str = "gpt-4o-mini"  # 用于计算 token 数的模型
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        k = self.search_kwargs.get("k", 4)
+        embedding = get_embedding_model().embed_query(query)
+        executor = get_search_executor()
+        futures = [(name, executor.submit(job.search_by_vector, embedding, k)) for name, job in self.shards]
+
+        results = []
+        for name, future in futures:
+            for doc, distance in future.result():
+                # 文档库中的文本块标注来源文件名
+                results.append((Document(page_content=doc.page_content, metadata={**doc.metadata, "source": name}),
+                                distance))
+        results.sort(key=lambda item: item[1])
+        docs = [doc for doc, _ in results[:k]]
+        if not self.token_budget:
+            return docs
+
+        docs, stats = pack_context(docs, self.token_budget, self.model_name)
+        logger.info(
+            "上下文打包：候选 %d 块 %d tokens，装入 %d 块 %d tokens，相比直接使用前 %d 块（%d tokens）%+d tokens",
+            stats["candidates"], stats["candidate_tokens"], stats["packed"], stats["packed_tokens"],
+            CONTEXT_PACKING_CONFIG["baseline_k"], stats["baseline_tokens"], stats["token_delta"]
         )
+        return docs
+
 
-        # 传递 chat_history 参数
-        result = chain.invoke({
-            "question": query,
-            "chat_history": chat_history
-        })
+@st.cache_resource
+def get_indexing_executor():
+    """进程级共享的索引线程池"""
+    return ThreadPoolExecutor(max_workers=INDEXING_WORKERS, thread_name_prefix="indexing")
+
+
+@st.cache_resource
+def get_running_index_jobs():
+    """进程内正在进行的索引任务，多个会话同时上传同一文档时共用一个任务"""
+    return {}, threading.Lock()
+
+
+@st.cache_resource
+def get_search_executor():
+    """进程级共享的分片检索线程池（faiss 检索时释放 GIL，多个分片可以真正并行）"""
+    return ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="shard-search")
+
+
+def submit_indexing_job(path, fingerprint):
+    """提交后台索引任务，相同文档已有任务在进行时直接返回该任务"""
+    jobs, lock = get_running_index_jobs()
+    with lock:
+        job = jobs.get(fingerprint)
+        if job is None:
+            job = IndexingJob(fingerprint)
+            jobs[fingerprint] = job
+
+            def run_and_unregister():
+                try:
+                    job.run(path)
+                finally:
+                    with lock:
+                        jobs.pop(fingerprint, None)
+
+            get_indexing_executor().submit(run_and_unregister)
+    return job
+
+
+def get_corpus_shards():
+    """当前会话文档库的 [(文档名, 索引任务)]，内容相同的文档只检索一次"""
+    shards = {}
+    for doc in st.session_state.txt_docs.values():
+        shards.setdefault(doc["fingerprint"], (doc["name"], st.session_state.index_jobs[doc["fingerprint"]]))
+    return list(shards.values())
+
+
+def sync_text_corpus(text_files):
+    """让文档库与当前上传列表保持一致，移除已删除文件的文档和不再使用的索引任务"""
+    current_ids = {f.file_id for f in text_files}
+    for file_id in list(st.session_state.txt_docs):
+        if file_id not in current_ids:
+            del st.session_state.txt_docs[file_id]
+    fingerprints = {doc["fingerprint"] for doc in st.session_state.txt_docs.values()}
+    for fingerprint in list(st.session_state.index_jobs):
+        if fingerprint not in fingerprints:
+            del st.session_state.index_jobs[fingerprint]
+
+
+def wait_for_index(jobs):
+    """等待文档库可检索；允许部分回答时，只要任一文档已有文本块写入就立即返回"""
+    def ready():
+        if all(job.finished.is_set() for job in jobs):
+            return True
+        return RAG_PARTIAL_ANSWERS and any(job.done > 0 for job in jobs)
+
+    if ready():
+        return
+
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    while not ready():
+        done = sum(job.done for job in jobs)
+        progress = sum(job.progress() for job in jobs) / len(jobs)
+        status_text.text(f"正在建立文档索引，已处理 {done} 个文本块（{progress:.0%}）...")
+        progress_bar.progress(progress)
+        time.sleep(0.2)
+    progress_bar.empty()
+    status_text.empty()
+
+
+def render_indexing_status(shards):
+    """显示文档库索引状态，索引进行中时每秒轮询刷新"""
+    for name, job in shards:
+        if job.error is not None:
+            st.error(f"文档 '{name}' 索引失败: {job.error}")
+    if all(job.finished.is_set() for _, job in shards):
+        ready = [job for _, job in shards if job.error is None]
+        st.caption(f"✅ 文档索引已就绪：{len(ready)} 个文档，共 {sum(job.done for job in ready)} 个文本块"
+                   f"（嵌入缓存命中 {sum(job.hits for job in ready)} 块，"
+                   f"新计算 {sum(job.misses for job in ready)} 块）")
+    else:
+        poll_indexing_progress(shards)
 
-        return {"answer": result['answer']}
+
+@st.fragment(run_every=1)
+def poll_indexing_progress(shards):
+    # 全部索引完成后刷新整个页面，轮询随之停止
+    if all(job.finished.is_set() for _, job in shards):
+        st.rerun()
+    for name, job in shards:
+        if not job.finished.is_set():
+            st.progress(job.progress(), text=f"正在后台建立索引 {name}：已处理 {job.done} 个文本块 ...")
+
+
+# ============================================================
+# 追问改写
+# ============================================================
+def is_standalone_question(question, chat_history):
+    """本地判断问题能否脱离上文单独检索：没有对话历史，或不含指代、承接词且不过短"""
+    if not chat_history:
+        return True
+    text = question.strip().lower()
+    return len(text) >= 6 and not FOLLOW_UP_PATTERN.search(text)
+
+
+def condense_question(question, chat_history, llm, callbacks=None):
+    """结合对话历史把追问改写为独立问题（与 ConversationalRetrievalChain 使用相同的提示词）"""
+    prompt = CONDENSE_QUESTION_PROMPT.format(chat_history=get_buffer_string(chat_history), question=question)
+    return llm.invoke(prompt, config={"callbacks": callbacks}).content.strip()
+
+
+def prepare_rag_question(question, chat_history, condense_llm, retriever, fast_mode):
+    """得到用于检索和回答的独立问题及检索结果，返回 (独立问题, 文本块, 各步骤耗时)
+
+    快速模式下独立问题直接检索；需要改写时作为本会话的当前请求在后台线程调用模型（可被停止按钮取消），
+    同时用原始问题做推测检索，改写结果与原问题一致时复用该结果。
+    各步骤耗时只统计实际增加的等待时间，与改写并行的推测检索单独列出。
+    """
+    timings = {}
+    if not chat_history or (fast_mode and is_standalone_question(question, chat_history)):
+        start = time.perf_counter()
+        docs = retriever.invoke(question)
+        timings["检索"] = time.perf_counter() - start
+        return question, docs, timings
+
+    start = time.perf_counter()
+    run = start_request(lambda callbacks: condense_question(question, chat_history, condense_llm, callbacks))
+    speculative_docs = None
+    if fast_mode and RAG_CONDENSE_CONFIG["speculative_retrieval"]:
+        speculative_start = time.perf_counter()
+        speculative_docs = retriever.invoke(question)
+        timings["推测检索"] = time.perf_counter() - speculative_start
+    # 等待期间照常显示已等待时间，并响应停止按钮和超时；改写模型流式输出的 token 不显示
+    for _ in run.events():
+        pass
+    standalone = run.wait() or question
+    timings["改写"] = time.perf_counter() - start
+
+    if speculative_docs is not None and standalone.strip() == question.strip():
+        return standalone, speculative_docs, timings
+    start = time.perf_counter()
+    docs = retriever.invoke(standalone)
+    timings["检索"] = time.perf_counter() - start
+    return standalone, docs, timings
+
+
+def format_timings(timings):
+    return "⏱️ " + " · ".join(f"{step} {seconds:.2f}s" for step, seconds in timings.items())
+
+
+# RAG代理 - 处理TXT文件
+def rag_agent(query):
+    try:
+        start = time.perf_counter()
+        # 各文档的索引在上传时已于后台开始建立，这里等待其可用
+        shards = get_corpus_shards()
+        wait_for_index([job for _, job in shards])
+        errors = [job.error for _, job in shards if job.error is not None]
+        shards = [(name, job) for name, job in shards if job.error is None]
+        if not shards:
+            raise errors[0]
+
+        # 创建检索链
+        model = get_chat_model(streaming=True)
+
+        retriever = CorpusRetriever(
+            shards=shards,
+            search_kwargs={"k": CONTEXT_PACKING_CONFIG["fetch_k"]},
+            token_budget=CONTEXT_PACKING_CONFIG["token_budget"],
+            model_name=st.session_state.active_model
+        )
+
+        # 索引未完成时说明本次回答只基于已处理的部分
+        pending = [f"{name}（{job.progress():.0%}）" for name, job in shards if not job.finished.is_set()]
+        partial_note = f"\n\n（以下文档的索引仍在建立中，本回答只基于其已处理的部分：{'、'.join(pending)}）" \
+            if pending else ""
+
+        # 显式加载聊天历史
+        memory = get_conversation_memory()
+        chat_history = memory.load_memory_variables({})["history"]
+
+        # 追问改写（快速模式下尽量跳过）与检索
+        condense_llm = get_chat_model(
+            model=RAG_CONDENSE_CONFIG["condense_model"] or st.session_state.active_model,
+            temperature=0,
+            max_tokens=None
+        ) if st.session_state.rag_fast_mode else model
+        standalone, docs, timings = prepare_rag_question(
+            query, chat_history, condense_llm, retriever, st.session_state.rag_fast_mode
+        )
+
+        # 相似问题（按改写后的独立问题判断）直接返回缓存的回答；缓存按模型、生成参数和文档指纹区分，文档变化后不会误用旧回答
+        answer_cache = get_answer_cache()
+        cache_scope = ("rag", *generation_scope(), tuple(sorted(job.fingerprint for _, job in shards)))
+        cached = answer_cache.lookup(cache_scope, standalone)
+        if cached is not None:
+            memory.save_context({"input": query}, {"output": cached})
+            st.write(cached)
+            return {"answer": cached, "streamed": True, "timings": timings}
+
+        # 基于检索到的文本块回答独立问题，回答逐 token 写入页面
+        answer_start = time.perf_counter()
+        qa_chain = get_llm_registry().qa_chain(model)
+        run = start_request(lambda callbacks: qa_chain.invoke(
+            {"input_documents": docs, "question": standalone}, config={"callbacks": callbacks}
+        )['output_text'])
+        streamed = st.write_stream(run.tokens())
+        answer = run.wait()
+        if not streamed:
+            st.write(answer)
+        if partial_note:
+            st.caption(partial_note.strip())
+        timings["回答"] = time.perf_counter() - answer_start
+        # 首字耗时从收到问题开始计算，包含等待索引、改写和检索
+        timings["首字"] = run.first_output_at - start if run.first_output_at else timings["回答"]
+        logger.info("文档问答耗时：%s", format_timings(timings))
+
+        # 记录本轮对话，后续追问可以据此改写
+        memory.save_context({"input": query}, {"output": answer})
+        # 索引未完成时的回答只基于部分文档，不写入缓存
+        if not partial_note:
+            answer_cache.store(cache_scope, standalone, answer)
+        return {"answer": answer + partial_note, "streamed": True, "timings": timings}
     except Exception as e:
         st.error(f"文本处理出错：{e}")
         return {"answer": "无法处理文本内容，请重试或上传其他文件。"}
@@ -497,6 +3015,9 @@ def main():
     )
 
     init_session_state()
+    start_embedding_warmup()
+    # 页面重跑时上一次运行已被打断，它留下的后台请求不会再有人接收输出
+    cancel_active_request()
 
     # 页面标题
     header_container = st.container()
@@ -516,6 +3037,10 @@ def main():
         api_key = st.text_input('请输入OpenAI API Key', type='password', value=st.session_state.API_KEY)
         if api_key:
             st.session_state.API_KEY = api_key
+        st.session_state.base_url = st.text_input(
+            '接口地址 (base_url)', value=st.session_state.base_url,
+            help="OpenAI 兼容接口的地址，本地压测时可指向 mock_openai_server.py"
+        ).strip() or LLM_BASE_URL
 
         if st.button("🔄 新建会话", use_container_width=True):
             # 保存当前会话到历史会话
@@ -530,11 +3055,13 @@ def main():
             # 重置当前会话
             st.session_state.current_session_messages = [
                 {'role': 'ai', 'content': '你好，我是你的AI助手，请问有什么能帮助你吗？'}]
-            st.session_state.memory = ConversationBufferMemory(return_messages=True)
+            st.session_state.memory = create_memory(st.session_state.memory_strategy)
             st.session_state.viewing_history = False
-            st.session_state.data_df = None
-            st.session_state.txt_content = None
-            st.session_state.is_new_file = True
+            reset_data_state()
+            st.session_state.parsed_data = OrderedDict()
+            st.session_state.upload_fingerprints = {}
+            st.session_state.txt_docs = {}
+            st.session_state.index_jobs = {}
             st.session_state.session_id = uuid.uuid4().hex
             st.session_state.file_uploader_key = str(uuid.uuid4())  # 生成新的随机键
             st.rerun()
@@ -573,10 +3100,13 @@ def main():
         st.subheader("⚙️ 模型配置")
         st.session_state.selected_model = st.selectbox(
             "选择AI模型",
-            ["gpt-4o", "gpt-4o-mini", "gpt-4", "gpt-3.5-turbo"],
+            ["gpt-4o", "gpt-4o-mini", "gpt-4", "gpt-3.5-turbo", "auto"],
             index=1,
+            format_func=lambda name: "auto（按问题复杂度自动选择）" if name == "auto" else name,
             help="选择要使用的AI模型"
         )
+        if st.session_state.selected_model == "auto":
+            render_route_stats()
 
         st.session_state.model_temperature = st.slider(
             "温度 (Temperature)",
@@ -596,6 +3126,24 @@ def main():
             help="指导AI如何回答问题的系统级提示"
         )
 
+        st.session_state.rag_fast_mode = st.toggle(
+            "⚡ 快速文档问答",
+            value=st.session_state.rag_fast_mode,
+            help="独立问题跳过追问改写，需要改写时使用低成本模型并同时检索原始问题"
+        )
+
+        st.session_state.memory_strategy = st.selectbox(
+            "对话记忆",
+            list(MEMORY_STRATEGIES),
+            index=list(MEMORY_STRATEGIES).index(st.session_state.memory_strategy),
+            format_func=MEMORY_STRATEGIES.get,
+            help="限制每次请求携带的对话历史长度，控制提示词大小、费用和延迟"
+        )
+        render_memory_stats()
+
+        render_cache_stats()
+        render_rate_limit_stats()
+
     # 查看历史会话
     if st.session_state.viewing_history and st.session_state.current_session_index is not None:
         st.subheader("📜 历史消息")
@@ -613,41 +3161,79 @@ def main():
     else:
         # 文件上传区域
         st.subheader("📤 上传数据文件")
-        file = st.file_uploader(
-            "上传CSV、Excel或TXT文件",
+        files = st.file_uploader(
+            "上传CSV、Excel或TXT文件（可同时上传多个TXT文件组成文档库）",
             type=["csv", "xlsx", "txt"],
+            accept_multiple_files=True,
             label_visibility="collapsed",
             key=st.session_state.get('file_uploader_key', 'default_file_uploader')
         )
 
-        # 处理文件上传
-        if file:
+        # 处理文件上传：数据文件一次分析一个，TXT 文件全部加入文档库
+        data_files = [f for f in files if f.name.split(".")[-1].lower() in ["csv", "xlsx"]]
+        text_files = [f for f in files if f.name.split(".")[-1].lower() == "txt"]
+        if len(data_files) > 1:
+            st.warning(f"一次只能分析一个数据文件，当前使用 '{data_files[0].name}'")
+        for file in data_files[:1] + text_files:
             process_uploaded_file(file)
+        if files:
+            sync_text_corpus(text_files)
+            if not data_files:
+                reset_data_state()
 
         # 显示当前模式
         st.markdown(f"**当前模式**: {st.session_state.current_mode}")
 
         # 重置文件状态逻辑
-        if file is None and (st.session_state.data_df is not None or st.session_state.txt_content is not None):
+        if not files and (st.session_state.data_df is not None or st.session_state.txt_docs):
             # 用户已删除文件，重置相关状态
-            st.session_state.data_df = None
-            st.session_state.txt_content = None
-            st.session_state.is_new_file = True
+            reset_data_state()
+            st.session_state.parsed_data = OrderedDict()
+            st.session_state.upload_fingerprints = {}
+            st.session_state.txt_docs = {}
+            st.session_state.index_jobs = {}
             st.toast("文件已移除，现在可进行文本问答")
             # 清除预览区域
             st.rerun()
-        elif file:
+        elif files:
             # 处理文件上传后显示预览
             try:
-                file_type = file.name.split('.')[-1].lower()
-                if file_type in ['csv', 'xlsx']:
+                if st.session_state.data_df is not None:
                     with st.expander("👀 数据预览", expanded=True):
                         st.dataframe(st.session_state.data_df.head(10), use_container_width=True)
                         st.caption(
                             f"数据维度: {st.session_state.data_df.shape[0]} 行 × {st.session_state.data_df.shape[1]} 列")
-                elif file_type == 'txt':
-                    with st.expander("📝 文本内容预览", expanded=True):
-                        st.text_area("", st.session_state.txt_content, height=300, label_visibility="collapsed")
+                        parse = st.session_state.data_parse
+                        dataset = parse["data"]
+                        source = {"arrow": "读取 Arrow 缓存", "duckdb": "导入 DuckDB "}.get(dataset["source"], "解析")
+                        st.caption(
+                            f"{source}耗时 {parse['seconds']:.2f}s，此后 {parse['reuses']} 次页面重跑直接复用，"
+                            f"累计节省约 {parse['seconds'] * parse['reuses']:.1f}s")
+                        if dataset["source"] == "duckdb":
+                            st.caption(
+                                f"SQL 模式：{format_bytes(dataset['original_bytes'])} 的数据保存在磁盘上的 DuckDB 中，"
+                                f"分析时只有查询结果读入内存")
+                        else:
+                            st.caption(
+                                f"内存占用: {format_bytes(dataset['original_bytes'])} → "
+                                f"{format_bytes(dataset['compact_bytes'])}（紧凑列式表示，节省 "
+                                f"{1 - dataset['compact_bytes'] / max(dataset['original_bytes'], 1):.0%}）")
+                if st.session_state.txt_docs:
+                    # 大文件只按页读取，避免把全文推送到浏览器
+                    docs = list(st.session_state.txt_docs.values())
+                    with st.expander(f"📝 文本内容预览（文档库共 {len(docs)} 个文档）", expanded=True):
+                        doc = docs[0]
+                        if len(docs) > 1:
+                            doc = docs[st.selectbox("选择要预览的文档", range(len(docs)),
+                                                    format_func=lambda i: docs[i]["name"], key="txt_preview_doc")]
+                        page_count = len(doc["page_offsets"]) - 1
+                        page = 1
+                        if page_count > 1:
+                            page = st.number_input(f"页码（共 {page_count} 页）", 1, page_count, 1,
+                                                   key=f"txt_preview_page_{doc['fingerprint']}")
+                        st.text_area("", read_text_page(doc, page - 1), height=300, label_visibility="collapsed")
+                        st.caption(f"文件大小: {doc['size'] / 1024:.1f} KB")
+                    render_indexing_status(get_corpus_shards())
             except Exception as e:
                 st.error(f"文件预览错误: {str(e)}")
 
@@ -668,17 +3254,27 @@ def main():
             with st.chat_message("user"):
                 st.write(prompt)
 
-            # AI处理区域
-            with st.spinner('🤖 AI正在思考，请稍等...'):
+            # AI处理区域：回答直接流式写入助手消息
+            with st.chat_message("assistant"):
+                cancel_slot = st.empty()
+                cancel_slot.button("⏹ 停止生成", key="cancel_request", on_click=cancel_active_request,
+                                   kwargs={"reason": "⏹ 已停止生成"})
                 try:
-                    # 根据文件类型选择处理方式
-                    if st.session_state.data_df is not None:
-                        response = dataframe_agent(st.session_state.data_df, prompt)
-                    elif st.session_state.txt_content is not None:
-                        response = rag_agent(prompt)
-                    else:
-                        # 没有文件时使用文本代理
-                        response = {"answer": text_agent(prompt)}
+                    st.session_state.active_model = choose_model(prompt)
+                    request_start = time.perf_counter()
+                    with st.spinner('🤖 AI正在思考，请稍等...'):
+                        # 根据文件类型选择处理方式
+                        if st.session_state.data_df is not None:
+                            response = dataframe_agent(st.session_state.data_df, prompt)
+                        elif st.session_state.txt_docs:
+                            response = rag_agent(prompt)
+                        else:
+                            # 没有文件时使用文本代理
+                            response = text_agent(prompt)
+
+                    cancel_slot.empty()
+                    st.session_state.active_request = None
+                    get_route_stats().record(st.session_state.active_model, time.perf_counter() - request_start)
 
                     # 确保response是字典类型
                     if not isinstance(response, dict):
@@ -692,13 +3288,9 @@ def main():
                         # 提取文本回答
                         ai_response = response.get("answer", "没有获取到回答内容")
 
-                        # 图表关键词列表
-                        chart_keywords = ["图表", "柱状图", "折线图", "饼图", "可视化", "展示图", "散点图", "箱线图",
-                                          "直方图", "面积图"]
-
                         # 只在用户明确要求图表且response是字典时才检查
                         if isinstance(response, dict) and "charts" in response:
-                            if any(kw in prompt.lower() for kw in chart_keywords):
+                            if any(kw in prompt.lower() for kw in CHART_KEYWORDS):
                                 for chart in response["charts"]:
                                     if "type" in chart and "data" in chart:
                                         create_chart(chart["data"], chart["type"])
@@ -709,18 +3301,22 @@ def main():
                     # 添加AI响应到当前会话
                     st.session_state.current_session_messages.append({'role': 'ai', 'content': ai_response})
 
-                    # 显示AI响应
-                    with st.chat_message("assistant"):
-                        if "error" in response:
-                            st.error(ai_response)
-                        else:
+                    # 显示AI响应（流式输出的回答已经显示）
+                    if "error" in response:
+                        st.error(ai_response)
+                    else:
+                        if not response.get("streamed"):
                             st.write(ai_response)
+                        if "timings" in response:
+                            st.caption(format_timings(response["timings"]))
+                        if st.session_state.selected_model == "auto":
+                            st.caption(f"🧭 自动路由：{st.session_state.active_model}")
 
                 except Exception as e:
+                    cancel_slot.empty()
                     error_msg = f"处理请求时出错: {str(e)}"
                     st.session_state.current_session_messages.append({'role': 'ai', 'content': error_msg})
-                    with st.chat_message("assistant"):
-                        st.error(error_msg)
+                    st.error(error_msg)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+"""端到端压测：并发回放录制的会话，统计文本问答、数据分析和文档问答三种模式的延迟分位数与吞吐量
+
+用法:
+    python load_test.py --mock --users 8 --repeat 3
+    python load_test.py --app app2 --sessions sessions.jsonl --base-url http://127.0.0.1:8765/v1
+
+每个虚拟用户是一个子进程，用 streamlit 的 AppTest 运行独立的会话，每个问题是一次页面重跑，
+和浏览器中的用户一样经过文件处理、模型路由、缓存、限流和流式输出的完整路径。
+（AppTest 运行时会替换全局的 Runtime 实例，同一进程内不能并发运行多个。）
+--sessions 是 JSONL 文件，每行一个录制的会话:
+    {"mode": "data", "file": "sales.csv", "questions": ["哪个地区销售额最高？", "按月份统计销售额"]}
+mode 为 text / data / rag，data 和 rag 模式需要 file（CSV、XLSX 或 TXT）。
+未指定时使用内置的示例会话。--mock 会在进程内启动 mock_openai_server 作为模型接口。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+import mock_openai_server
+
+SAMPLE_QUESTIONS = {
+    "text": ["你好，介绍一下你自己", "什么是数据分析？", "用三句话总结刚才的回答"],
+    "data": ["哪个地区的销售额最高？", "统计每个月的销售额", "分析各产品的平均单价"],
+    "rag": ["文档主要讲了什么？", "其中提到了哪些注意事项？", "它的第二点具体是什么意思？"],
+}
+
+
+def replay_turn(repo_dir, app_name, base_url, file_path):
+    """压测页面脚本：加载会话文件并回答 session_state 中的 load_test_question
+
+    AppTest 只取函数体作为页面脚本运行，所以这里需要自带全部导入。
+    """
+    import importlib
+    import io
+    import os
+    import sys
+    import time
+
+    import streamlit as st
+
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    app = importlib.import_module(app_name)
+    app.init_session_state()
+    st.session_state.API_KEY = "load-test"
+    st.session_state.base_url = base_url
+
+    # 模拟上传：与页面一样每次重跑都经过文件处理
+    if file_path:
+        with open(file_path, "rb") as f:
+            upload = io.BytesIO(f.read())
+        upload.name = os.path.basename(file_path)
+        upload.file_id = file_path
+        upload.size = len(upload.getbuffer())
+        app.process_uploaded_file(upload)
+        if upload.name.lower().endswith(".txt"):
+            app.sync_text_corpus([upload])
+
+    question = st.session_state.get("load_test_question")
+    if not question:
+        return
+    st.session_state.current_session_messages.append({'role': 'human', 'content': question})
+    st.session_state.active_model = app.choose_model(question)
+    start = time.perf_counter()
+    if st.session_state.data_df is not None:
+        response = app.dataframe_agent(st.session_state.data_df, question)
+    elif st.session_state.txt_docs:
+        response = app.rag_agent(question)
+    else:
+        response = app.text_agent(question)
+    latency = time.perf_counter() - start
+    st.session_state.active_request = None
+
+    response = response if isinstance(response, dict) else {"answer": str(response)}
+    st.session_state.current_session_messages.append({'role': 'ai', 'content': response.get("answer", "")})
+    st.session_state.load_test_result = {
+        "latency": latency,
+        "error": response.get("error"),
+        "timings": response.get("timings"),
+    }
+
+
+def write_sample_sessions(directory):
+    """生成内置示例会话用到的数据文件和文档"""
+    rng = np.random.default_rng(0)
+    csv_path = os.path.join(directory, "sales.csv")
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write("日期,地区,产品,数量,单价\n")
+        for i in range(2000):
+            f.write(f"2024-{i % 12 + 1:02d}-{i % 28 + 1:02d},{rng.choice(['华东', '华南', '华北', '西南'])},"
+                    f"{rng.choice(['A', 'B', 'C'])},{rng.integers(1, 100)},{rng.uniform(10, 500):.2f}\n")
+
+    txt_path = os.path.join(directory, "manual.txt")
+    with open(txt_path, "w", encoding="utf-8") as f:
+        for i in range(200):
+            f.write(f"第{i + 1}节：设备在使用前需要检查电源和网络连接。注意事项第{i % 5 + 1}点是定期备份数据，"
+                    f"并在出现异常时查看日志。\n")
+
+    return [
+        {"mode": "text", "file": None, "questions": SAMPLE_QUESTIONS["text"]},
+        {"mode": "data", "file": csv_path, "questions": SAMPLE_QUESTIONS["data"]},
+        {"mode": "rag", "file": txt_path, "questions": SAMPLE_QUESTIONS["rag"]},
+    ]
+
+
+def load_sessions(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_session(session, app_name, base_url, timeout, results):
+    """在一个全新的会话中依次回放问题，记录每个问题的 (模式, 开始时间, 延迟, 错误)"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    at = AppTest.from_function(replay_turn, args=(repo_dir, app_name, base_url, session.get("file")),
+                               default_timeout=timeout)
+    for question in session["questions"]:
+        at.session_state["load_test_question"] = question
+        started_at = time.time()
+        start = time.perf_counter()
+        try:
+            at.run()
+            if at.exception:
+                raise RuntimeError(at.exception[0].message)
+            # 代理内部的异常以 st.error 的形式显示在页面上
+            result = at.session_state["load_test_result"]
+            error = result["error"] or (at.error[0].value if len(at.error) else None)
+            record = (session["mode"], started_at, result["latency"], error)
+        except Exception as e:
+            record = (session["mode"], started_at, time.perf_counter() - start, str(e))
+        results.put(record)
+
+
+def virtual_user(pending, results, app_name, base_url, timeout):
+    """子进程：不断取出待回放的会话，直到队列为空"""
+    while True:
+        try:
+            session = pending.get_nowait()
+        except queue.Empty:
+            return
+        run_session(session, app_name, base_url, timeout, results)
+
+
+def report(results):
+    """按模式输出延迟分位数；吞吐量按从第一个请求开始到最后一个请求结束的时间计算，不含子进程启动"""
+    wall_seconds = max(start + latency for _, start, latency, _ in results) - min(r[1] for r in results)
+    print(f"{'模式':<8}{'请求数':>8}{'失败':>6}{'p50(s)':>10}{'p95(s)':>10}{'p99(s)':>10}{'吞吐(次/s)':>12}")
+    for mode in ["text", "data", "rag", "all"]:
+        rows = [r for r in results if mode == "all" or r[0] == mode]
+        if not rows:
+            continue
+        latencies = np.array([latency for _, _, latency, error in rows if error is None])
+        failures = sum(error is not None for *_, error in rows)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (float("nan"),) * 3
+        print(f"{mode:<8}{len(rows):>8}{failures:>6}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}"
+              f"{len(latencies) / wall_seconds:>12.2f}")
+    errors = {error for *_, error in results if error is not None}
+    for error in list(errors)[:5]:
+        print(f"错误示例: {error}")
+    print(f"\n压测时长 {wall_seconds:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="app10", help="被测应用模块（app10 或 app2）")
+    parser.add_argument("--sessions", help="录制的会话 JSONL 文件")
+    parser.add_argument("--users", type=int, default=4, help="并发虚拟用户数")
+    parser.add_argument("--repeat", type=int, default=1, help="每个会话回放的次数")
+    parser.add_argument("--timeout", type=float, default=300, help="单个问题的超时时间（秒）")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--base-url", help="模型接口地址")
+    target.add_argument("--mock", action="store_true", help="在进程内启动模拟服务器")
+    parser.add_argument("--latency", type=float, default=0.3, help="模拟服务器首个 token 前的延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="模拟服务器数据块之间的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务器返回 429 的概率")
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    server = None
+    if args.mock:
+        behavior = mock_openai_server.MockBehavior(latency=args.latency, jitter=args.latency / 2,
+                                                   token_delay=args.token_delay, error_rate=args.error_rate)
+        server = mock_openai_server.make_server(behavior=behavior)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}/v1"
+        print(f"模拟服务器: {base_url}")
+
+    sample_dir = tempfile.TemporaryDirectory()
+    sessions = load_sessions(args.sessions) if args.sessions else write_sample_sessions(sample_dir.name)
+    context = multiprocessing.get_context("spawn")
+    pending, results = context.Queue(), context.Queue()
+    for _ in range(args.repeat):
+        for session in sessions:
+            pending.put(session)
+    total = args.repeat * len(sessions)
+
+    print(f"回放 {total} 个会话，并发用户 {args.users}...\n")
+    users = [
+        context.Process(target=virtual_user, args=(pending, results, args.app, base_url, args.timeout))
+        for _ in range(args.users)
+    ]
+    for process in users:
+        process.start()
+    # 子进程异常退出时不会一直等待它的结果
+    records = []
+    while any(process.is_alive() for process in users) or not results.empty():
+        try:
+            records.append(results.get(timeout=1))
+        except queue.Empty:
+            pass
+
+    report(records)
+    if server is not None:
+        server.shutdown()
+    sample_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
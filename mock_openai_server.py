@@ -0,0 +1,193 @@
+"""本地 OpenAI 兼容模拟服务器：实现 /v1/chat/completions（含流式输出）和 /v1/models，用于压测和离线调试
+
+用法:
+    python mock_openai_server.py --port 8765 --latency 0.5 --token-delay 0.02
+    python mock_openai_server.py --script mock_rules.json --error-rate 0.05
+
+然后把应用侧边栏的接口地址（或环境变量 OPENAI_BASE_URL）设为 http://127.0.0.1:8765/v1。
+
+--script 指定的 JSON 文件是一个规则列表，按顺序匹配请求中全部消息拼接后的文本:
+    [{"match": "销售额", "response": "总销售额为 100 万元", "latency": 1.0}]
+没有规则匹配时按请求类型生成默认回答：数据分析代理的请求直接给出 Final Answer，
+追问改写的请求原样返回追问，其余请求回显问题。
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_MODELS = ["gpt-4o", "gpt-4o-mini", "gpt-4", "gpt-3.5-turbo"]
+# 流式输出时每个数据块包含的字符数
+STREAM_CHUNK_CHARS = 4
+
+
+def default_response(prompt):
+    """没有规则匹配时的回答"""
+    if "Action Input:" in prompt:
+        # ReAct 格式，让数据分析代理一步结束
+        return "Thought: 模拟服务器直接给出答案\nFinal Answer: 这是来自本地模拟服务器的分析结果"
+    match = re.search(r"Follow Up Input: (.*)\nStandalone question:", prompt)
+    if match:
+        return match.group(1).strip()
+    question = prompt.strip().splitlines()[-1] if prompt.strip() else ""
+    return f"这是来自本地模拟服务器的回答：{question[:50]}"
+
+
+class MockBehavior:
+    """回答规则与注入的延迟、错误"""
+
+    def __init__(self, rules=None, latency=0.0, jitter=0.0, token_delay=0.0, error_rate=0.0, seed=None):
+        self.rules = [(re.compile(rule["match"]), rule) for rule in rules or []]
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def respond(self, prompt):
+        """返回 (回答文本, 首个 token 前的延迟秒数, 是否注入 429)"""
+        with self._lock:
+            self.requests += 1
+            rate_limited = self._random.random() < self.error_rate
+            latency = self.latency + self._random.uniform(0, self.jitter)
+        for pattern, rule in self.rules:
+            if pattern.search(prompt):
+                return rule["response"], rule.get("latency", latency), rate_limited
+        return default_response(prompt), latency, rate_limited
+
+
+def message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持长连接，和真实接口一样可以复用连接
+    behavior = MockBehavior()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": name, "object": "model", "owned_by": "mock"} for name in MOCK_MODELS
+            ]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        prompt = "\n".join(message_text(m) for m in request.get("messages", []))
+        text, latency, rate_limited = self.behavior.respond(prompt)
+        if rate_limited:
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                            {"Retry-After": "1"})
+            return
+
+        time.sleep(latency)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request.get("model", MOCK_MODELS[0])
+        usage = {
+            "prompt_tokens": len(prompt),
+            "completion_tokens": len(text),
+            "total_tokens": len(prompt) + len(text),
+        }
+        if request.get("stream"):
+            self._stream(completion_id, model, text, usage, (request.get("stream_options") or {}).get("include_usage"))
+        else:
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def _stream(self, completion_id, model, text, usage, include_usage):
+        """按 SSE 格式分块输出，块之间注入 token_delay 延迟"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices, **extra):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": choices, **extra}
+            self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for i in range(0, len(text), STREAM_CHUNK_CHARS):
+            if i and self.behavior.token_delay:
+                time.sleep(self.behavior.token_delay)
+            event([{"index": 0, "delta": {"content": text[i:i + STREAM_CHUNK_CHARS]}, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if include_usage:
+            event([], usage=usage)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+def make_server(host="127.0.0.1", port=0, behavior=None):
+    """创建模拟服务器（port=0 时自动选择空闲端口），调用方负责 serve_forever / shutdown"""
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"behavior": behavior or MockBehavior()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--script", help="回答规则 JSON 文件")
+    parser.add_argument("--latency", type=float, default=0.3, help="首个 token 前的固定延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="额外随机延迟的上限（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="流式输出时数据块之间的延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 429 的概率")
+    args = parser.parse_args()
+
+    rules = None
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            rules = json.load(f)
+    behavior = MockBehavior(rules, args.latency, args.jitter, args.token_delay, args.error_rate)
+    server = make_server(args.host, args.port, behavior)
+    print(f"模拟服务器已启动: http://{args.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""进程池任务
+
+Streamlit 以 __main__ 的身份执行页面脚本，脚本里定义的函数无法被子进程按名称导入，
+所以需要放到子进程中运行的任务统一定义在这个模块里。
+"""
+import os
+import uuid
+
+_embedding_model = None
+_encode_kwargs = {}
+
+
+def init_embedding_worker(model_name, model_kwargs, encode_kwargs, num_threads):
+    """嵌入进程初始化：每个子进程加载一份模型，并限制线程数避免子进程之间争抢 CPU"""
+    global _embedding_model, _encode_kwargs
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(num_threads)
+    _embedding_model = SentenceTransformer(model_name, **model_kwargs)
+    _encode_kwargs = dict(encode_kwargs)
+
+
+def encode_batch(texts, batch_size):
+    """在子进程中编码一批文本，返回 float32 向量矩阵"""
+    # 与 HuggingFaceEmbeddings.embed_documents 的预处理保持一致，保证向量可以混用
+    texts = [text.replace("\n", " ") for text in texts]
+    vectors = _embedding_model.encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        **_encode_kwargs
+    )
+    return vectors.astype("float32")
+
+
+def compact_dataframe(df, arrow_strings):
+    """就地把纯文本列转为 Arrow 字符串，占用更少内存，写入缓存后内存映射读取时可以直接引用文件页面
+
+    数据框会直接交给分析代理执行代码，所以数值列保持原来的 int64 / float64，也不转为分类类型：
+    整数降位后乘法会溢出，float32 求和会累积误差，分类列 groupby 时会产生空分组。混合类型的列保持不变。
+    """
+    import pandas as pd
+
+    if not arrow_strings:
+        return df
+    for i, (_, col) in enumerate(df.items()):
+        if col.dtype == object and pd.api.types.infer_dtype(col, skipna=True) == "string":
+            df.isetitem(i, col.astype("string[pyarrow]"))
+    return df
+
+
+def write_compact_arrow(df, original_bytes, path):
+    """把紧凑表示的 DataFrame 写入未压缩的 Arrow IPC 文件（读取时可直接内存映射），
+    原始内存占用记录在文件元数据中；无法转换为 Arrow 时抛出异常"""
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({**table.schema.metadata, b"original_bytes": str(original_bytes).encode()})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with ipc.new_file(tmp_path, table.schema) as writer:
+        writer.write_table(table)
+    # 已映射旧文件的会话不受影响，替换后的新文件是另一个 inode
+    os.replace(tmp_path, path)
+
+
+def read_compact_arrow(path):
+    """内存映射读取 Arrow 缓存，返回 (DataFrame, 原始内存占用)
+
+    文件未压缩，无缺失值的数值列和 Arrow 字符串列直接引用映射的页面，不复制到进程堆中；
+    这些页面属于操作系统的文件缓存，读取同一文件的进程和会话共享同一份。有缺失值的列仍会复制。
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    # 文本列读回时保持 Arrow 字符串，不转换为 Python 对象
+    string_types = {pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}
+    table = ipc.open_file(pa.memory_map(path)).read_all()
+    df = table.to_pandas(split_blocks=True, types_mapper=string_types.get)
+    return df, int(table.schema.metadata[b"original_bytes"])
+
+
+def parse_excel_sheet(workbook_path, sheet, cache_path, arrow_strings):
+    """在子进程中解析一个工作表，转为紧凑表示后写入 Arrow 缓存，返回行数"""
+    import pandas as pd
+
+    # openpyxl 引擎以只读模式流式读取，不把整个工作簿载入内存
+    df = pd.read_excel(workbook_path, sheet_name=sheet, engine="openpyxl")
+    original_bytes = int(df.memory_usage(deep=True).sum())
+    write_compact_arrow(compact_dataframe(df, arrow_strings), original_bytes, cache_path)
+    return len(df)
+
+
+def python_repl_worker(conn, cache_path):
+    """代码执行子进程：取得数据框后循环接收代理生成的代码，返回输出文本
+
+    cache_path 不为空时内存映射读取 Arrow 缓存，否则从 conn 接收数据框。
+    与 PythonAstREPLTool 一样，变量在多次执行之间保留。父进程关闭连接时退出。
+    """
+    df = read_compact_arrow(cache_path)[0] if cache_path else conn.recv()
+    from langchain_experimental.tools.python.tool import PythonAstREPLTool
+
+    tool = PythonAstREPLTool(locals={"df": df})
+    while True:
+        try:
+            code = conn.recv()
+        except EOFError:
+            return
+        try:
+            output = tool.run(code)
+        except Exception as e:
+            output = f"{type(e).__name__}: {e}"
+        conn.send(str(output))